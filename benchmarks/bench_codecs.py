@@ -0,0 +1,184 @@
+import io
+import json
+from pathlib import Path
+import sys
+import time
+
+from boozook.codex import ext, replace_tot
+from boozook.codex.stk import unpack_chunk
+from boozook.codex.stk_compress import COMPRESSION_LEVELS, pack_content
+
+from benchmarks import corpus
+
+
+BASELINE = Path(__file__).parent / 'baseline.json'
+
+
+def corpora(size):
+    return {
+        'script': corpus.script_bytecode(size),
+        'text': corpus.text_table(size),
+        'noise': corpus.noise(size),
+    }
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def cases(size, levels):
+    for name, data in corpora(size).items():
+        for level in levels:
+            yield f'pack_content[{level}]/{name}', len(data), lambda data=data, level=level: (
+                len(pack_content(data, level))
+            )
+        packed = pack_content(data)
+
+        def unpack(packed=packed, size=len(data)):
+            with io.BytesIO(packed) as stream:
+                stream.seek(4)
+                unpack_chunk(stream, size)
+            return len(packed)
+
+        yield f'unpack_chunk/{name}', len(data), unpack
+
+    width, height = 320, max(1, size // 320)
+    pixels = corpus.rle_sprite(width, height)
+    sprite = ext.pack_sprite(pixels)
+    yield 'pack_sprite/sprite', len(pixels), lambda: len(ext.pack_sprite(pixels))
+    yield 'unpack_sprite/sprite', len(pixels), lambda: (
+        len(sprite) if ext.unpack_sprite(sprite, width, height) else 0
+    )
+
+    text = corpus.tot_text(size)
+    yield 'escape_bytes/tot_text', len(text), lambda: len(
+        b''.join(replace_tot.escape_bytes(text))
+    )
+
+
+def run(size, repeat, levels):
+    results = {}
+    for name, length, func in cases(size, levels):
+        seconds, output_size = measure(func, repeat)
+        results[name] = {
+            'mb_s': length / seconds / (1 << 20),
+            'ratio': output_size / length,
+        }
+        print(
+            f'{name:32}',
+            f'{results[name]["mb_s"]:10.2f} MB/s',
+            f'{results[name]["ratio"]:8.3f}',
+            sep='\t',
+        )
+    return results
+
+
+def compare(results, baseline, threshold, ratio_threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['mb_s'] < base['mb_s'] * (1 - threshold):
+            regressions.append(
+                f'{name}: {result["mb_s"]:.2f} MB/s, baseline {base["mb_s"]:.2f} MB/s'
+            )
+        if result['ratio'] > base['ratio'] * (1 + ratio_threshold):
+            regressions.append(
+                f'{name}: ratio {result["ratio"]:.3f}, baseline {base["ratio"]:.3f}'
+            )
+    return regressions
+
+
+def menu():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='benchmark boozook codecs')
+    parser.add_argument(
+        '--size',
+        type=int,
+        default=256,
+        help='size of every synthetic corpus in KiB',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='number of runs per case, the fastest one is reported',
+    )
+    parser.add_argument(
+        '--levels',
+        nargs='*',
+        choices=COMPRESSION_LEVELS,
+        default=COMPRESSION_LEVELS,
+        help='compression levels to measure',
+    )
+    parser.add_argument(
+        '--baseline',
+        type=Path,
+        default=BASELINE,
+        help='baseline results to compare with',
+    )
+    parser.add_argument(
+        '--save',
+        action='store_true',
+        help='store the results as the new baseline',
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.2,
+        help='allowed throughput drop relative to the baseline',
+    )
+    parser.add_argument(
+        '--ratio-threshold',
+        type=float,
+        default=0.01,
+        help='allowed compression ratio growth relative to the baseline',
+    )
+    return parser.parse_args()
+
+
+def main(size, repeat, levels, baseline, save, threshold, ratio_threshold):
+    results = run(size << 10, repeat, levels)
+    if save:
+        baseline.write_text(json.dumps(results, indent=2, sort_keys=True) + '\n')
+        print(f'baseline saved to {baseline}')
+        return True
+    if not baseline.exists():
+        # Without a baseline the check could never fail
+        print(
+            f'no baseline at {baseline}, run with --save to create one',
+            file=sys.stderr,
+        )
+        return False
+    regressions = compare(
+        results,
+        json.loads(baseline.read_text()),
+        threshold,
+        ratio_threshold,
+    )
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return not regressions
+
+
+if __name__ == '__main__':
+    args = menu()
+
+    if not main(
+        args.size,
+        args.repeat,
+        args.levels,
+        args.baseline,
+        args.save,
+        args.threshold,
+        args.ratio_threshold,
+    ):
+        sys.exit(1)
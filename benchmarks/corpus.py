@@ -0,0 +1,69 @@
+import random
+import struct
+
+
+WORDS = (
+    b'the', b'you', b'and', b'Adi', b'Adibou', b'Gob', b'door', b'key', b'look',
+    b'take', b'open', b'here', b'there', b'what', b'is', b'a', b'of', b'to',
+    b'Blount', b'Chump', b'wizard', b'potion', b'castle', b'garden', b'!', b'?',
+)
+
+
+def words(rnd, count):
+    return b' '.join(rnd.choice(WORDS) for _ in range(count))
+
+
+def script_bytecode(size, seed=0):
+    # Opcodes followed by small operands, as in TOT scripts
+    rnd = random.Random(seed)
+    opcodes = [rnd.randrange(256) for _ in range(40)]
+    out = bytearray()
+    while len(out) < size:
+        out.append(rnd.choice(opcodes[: rnd.choice((8, 16, 40))]))
+        for _ in range(rnd.choice((0, 1, 1, 2, 2, 3))):
+            out += struct.pack('<H', rnd.choice((rnd.randrange(64), rnd.randrange(640))))
+        if rnd.random() < 0.05:
+            out += words(rnd, rnd.randrange(1, 6)) + b'\0'
+    return bytes(out[:size])
+
+
+def text_table(size, seed=0):
+    # Localized strings separated by terminators, with repeated phrases
+    rnd = random.Random(seed)
+    phrases = [words(rnd, rnd.randrange(2, 8)) for _ in range(60)]
+    out = bytearray()
+    while len(out) < size:
+        out += b' '.join(rnd.choice(phrases) for _ in range(rnd.randrange(1, 4)))
+        out += b'\0'
+    return bytes(out[:size])
+
+
+def tot_text(size, seed=0):
+    # Text items with the control codes handled by `replace_tot.escape_bytes`
+    rnd = random.Random(seed)
+    out = bytearray()
+    while len(out) < size:
+        out += rnd.choice((b'\x02', b'\x05')) + struct.pack(
+            '<2H', rnd.randrange(320), rnd.randrange(200)
+        )
+        for _ in range(rnd.randrange(1, 4)):
+            out += words(rnd, rnd.randrange(2, 10))
+            code = rnd.choice((None, None, 3, 4, 7, 8, 9))
+            if code in (3, 4):
+                out += bytes([code, rnd.randrange(16)])
+            elif code:
+                out.append(code)
+    return bytes(out) + b'\x01\x00'
+
+
+def rle_sprite(width, height, seed=0):
+    # 4-bit pixels in horizontal runs, as in packed sprites
+    rnd = random.Random(seed)
+    pixels = []
+    while len(pixels) < width * height:
+        pixels += [rnd.randrange(16)] * rnd.choice((1, 2, 3, 5, 8, 13, 40, 300))
+    return pixels[: width * height]
+
+
+def noise(size, seed=0):
+    return random.Random(seed).randbytes(size)
@@ -1,39 +1,308 @@
-from collections import defaultdict
+from collections import ChainMap, defaultdict
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from contextlib import contextmanager, nullcontext
 from dataclasses import dataclass, field
+import fnmatch
+import hashlib
+import io
 import itertools
+import json
 import os
-from pathlib import Path
-from typing import Iterable, Iterator, MutableMapping, Optional, Sequence, Set
-
+import shutil
+from pathlib import Path, PurePath
+from typing import (
+    Iterable,
+    Iterator,
+    MutableMapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+)
+
+from boozook.cache import DEFAULT_MAX_SIZE, EntryCache
 from boozook.codex import stk
-from boozook.codex.stk_compress import recompress_archive
+from boozook.codex.stk_compress import (
+    COMPRESSION_LEVELS,
+    DEFAULT_LEVEL,
+    append_archive,
+    recompress_archive,
+)
 
 
 ARCHIVE_PATTERNS = ('*.STK','*.ITK','*.LTK','*.JTK',)
 
+DEFAULT_MAX_OPEN = 32
+
+INDEX_NAME = '.boozook-index.json'
+INDEX_VERSION = 1
+
+DIGESTS_NAME = '.boozook-digests.json'
+DIGESTS_VERSION = 1
+
+MANIFEST_NAME = '.boozook-manifest.json'
+MANIFEST_VERSION = 1
+
+
+class ArchivePool:
+    def __init__(
+        self,
+        max_open: int = DEFAULT_MAX_OPEN,
+        cache: Optional[EntryCache] = None,
+    ) -> None:
+        self.max_open = max_open
+        self.cache = cache
+        # Ordered from least to most recently used
+        self._open: dict[Path, stk.STKArchive] = {}
+        self._busy: defaultdict[Path, int] = defaultdict(int)
+        self._files: dict[Path, dict] = {}
+
+    @contextmanager
+    def borrow(self, path: str | os.PathLike) -> Iterator[stk.STKArchive]:
+        path = Path(path)
+        archive = self._open.pop(path, None)
+        if archive is None:
+            archive = stk.STKArchive(path, cache=self.cache)
+        self._open[path] = archive
+        self._busy[path] += 1
+        try:
+            self._trim()
+            yield archive
+        finally:
+            self._busy[path] -= 1
+            self._trim()
+
+    def _trim(self) -> None:
+        # Archives still being read from are kept open above the limit
+        for path in list(self._open):
+            if len(self._open) <= self.max_open:
+                break
+            if not self._busy[path]:
+                self._files.pop(path, None)
+                self._open.pop(path).close()
 
-def game_search(base_dir, patterns=('*',), patches=(), archives=ARCHIVE_PATTERNS):
-    parsed_files = set()
+    def files(self, path: str | os.PathLike, archive: stk.STKArchive) -> dict:
+        # Entries are listed once per open archive, searches only look them up
+        path = Path(path)
+        files = self._files.get(path)
+        if files is None:
+            files = self._files[path] = {file.name: file for file in archive}
+        return files
 
-    base_dir = Path(base_dir)
+    def close(self) -> None:
+        self._files.clear()
+        while self._open:
+            _, archive = self._open.popitem()
+            archive.close()
+
+    def __enter__(self) -> 'ArchivePool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class GameEntry(NamedTuple):
+    source: Path
+    archive: Optional[Path]
+    entry: Optional[stk.STKFileEntry | stk.STK21FileEntry]
+
+
+class GameSource(NamedTuple):
+    path: Path
+    is_archive: bool
+    names: list[str]
+
+
+class PatchedPath:
+    def __init__(self, name: str, data: bytes) -> None:
+        self.name = name
+        self._data = data
+
+    @property
+    def stem(self) -> str:
+        return PurePath(self.name).stem
+
+    @property
+    def suffix(self) -> str:
+        return PurePath(self.name).suffix
+
+    def with_suffix(self, suffix: str) -> PurePath:
+        return PurePath(self.name).with_suffix(suffix)
+
+    def open(self, mode: str = 'rb') -> io.BytesIO:
+        return io.BytesIO(self._data)
+
+    def read_bytes(self) -> bytes:
+        return self._data
+
+
+def _scan_directory(base_dir, rp):
+    patch_dir = base_dir / rp
+    names = sorted(
+        entry.name
+        for entry in patch_dir.iterdir()
+        if not (entry.is_dir() or entry.name in (INDEX_NAME, DIGESTS_NAME))
+    )
+    return {'path': rp, 'mtime': patch_dir.stat().st_mtime_ns, 'names': names}
+
+
+def _dump_entry(fname, entry):
+    return [fname, *(v.hex() if isinstance(v, bytes) else v for v in entry)]
+
+
+def _load_entry(row):
+    if len(row) == 4:
+        return stk.STKFileEntry(*row[1:])
+    return stk.STK21FileEntry(*row[1:5], *map(bytes.fromhex, row[5:]))
 
-    if patches is not None:
-        for rp in itertools.chain(patches, ('.',)):
-            patch_dir = base_dir / rp
-            for pattern in patterns:
-                for entry in sorted(patch_dir.glob(pattern)):
-                    if not (entry.is_dir() or entry.name in parsed_files):
-                        parsed_files.add(entry.name)
-                        yield pattern, entry
 
+def _patch_dirs(base_dir, patches):
+    if patches is None:
+        return []
+    return [rp for rp in itertools.chain(patches, ('.',)) if (base_dir / rp).is_dir()]
+
+
+def scan_game(base_dir, pool, patches=(), archives=ARCHIVE_PATTERNS):
+    base_dir = Path(base_dir)
+    directories = [_scan_directory(base_dir, rp) for rp in _patch_dirs(base_dir, patches)]
+    scanned = []
     for archive_pattern in archives:
         for archive_path in sorted(base_dir.glob(archive_pattern)):
-            with stk.open(archive_path) as archive:
-                for pattern in patterns:
-                    for entry in archive.glob(pattern):
-                        if entry.name not in parsed_files:
-                            parsed_files.add(entry.name)
-                            yield pattern, entry
+            stat = archive_path.stat()
+            with pool.borrow(archive_path) as archive:
+                entries = [
+                    _dump_entry(fname, archive.index[fname]) for fname in archive.index
+                ]
+            scanned.append(
+                {
+                    'path': archive_path.relative_to(base_dir).as_posix(),
+                    'size': stat.st_size,
+                    'mtime': stat.st_mtime_ns,
+                    'entries': entries,
+                }
+            )
+    return {'version': INDEX_VERSION, 'directories': directories, 'archives': scanned}
+
+
+def build_game_index(base_dir, scan):
+    # Every file of the game in search order, patch directories first.
+    # The first source to have a name provides it.
+    base_dir = Path(base_dir)
+    sources = [
+        GameSource(base_dir / directory['path'], False, directory['names'])
+        for directory in scan['directories']
+    ]
+
+    index = {}
+    for scanned in scan['archives']:
+        archive_path = base_dir / scanned['path']
+        names = []
+        for row in scanned['entries']:
+            names.append(row[0])
+            index.setdefault(row[0], GameEntry(archive_path, archive_path, _load_entry(row)))
+        sources.append(GameSource(archive_path, True, names))
+
+    for source in reversed(sources):
+        if not source.is_archive:
+            for fname in source.names:
+                index[fname] = GameEntry(source.path, None, None)
+    return index, sources
+
+
+def index_game(base_dir, pool, patches=(), archives=ARCHIVE_PATTERNS):
+    return build_game_index(base_dir, scan_game(base_dir, pool, patches, archives))
+
+
+def write_game_index(base_dir, target=None, patches=(), archives=ARCHIVE_PATTERNS):
+    base_dir = Path(base_dir)
+    target = Path(target) if target else base_dir / INDEX_NAME
+    # Created before scanning, as adding it to the directory changes its mtime.
+    # Entry digests are stored beside the index once rebuilds compute them.
+    target.touch()
+    target.with_name(DIGESTS_NAME).touch()
+    with ArchivePool() as pool:
+        scan = scan_game(base_dir, pool, patches, archives)
+    with target.open('r+', encoding='utf-8') as stream:
+        json.dump(scan, stream)
+        stream.truncate()
+    return target, scan
+
+
+def load_game_index(base_dir, target=None, patches=(), archives=ARCHIVE_PATTERNS):
+    # Returns None when the stored index does not match the game files anymore
+    base_dir = Path(base_dir)
+    target = Path(target) if target else base_dir / INDEX_NAME
+    try:
+        scan = json.loads(target.read_text(encoding='utf-8'))
+    except (FileNotFoundError, ValueError):
+        return None
+    if scan.get('version') != INDEX_VERSION:
+        return None
+
+    archive_paths = [
+        archive_path
+        for archive_pattern in archives
+        for archive_path in sorted(base_dir.glob(archive_pattern))
+    ]
+    if len(archive_paths) != len(scan['archives']):
+        return None
+    for archive_path, scanned in zip(archive_paths, scan['archives']):
+        stat = archive_path.stat()
+        if (
+            archive_path.relative_to(base_dir).as_posix() != scanned['path']
+            or stat.st_size != scanned['size']
+            or stat.st_mtime_ns != scanned['mtime']
+        ):
+            return None
+
+    # Loose files are cheap to list again when a directory has changed
+    stored = {directory['path']: directory for directory in scan['directories']}
+    directories = []
+    for rp in _patch_dirs(base_dir, patches):
+        directory = stored.get(rp)
+        if directory is None or (base_dir / rp).stat().st_mtime_ns != directory['mtime']:
+            directory = _scan_directory(base_dir, rp)
+        directories.append(directory)
+    scan['directories'] = directories
+    return build_game_index(base_dir, scan)
+
+
+def load_digests(base_dir, target):
+    # Digests of archives changed since they were recorded are dropped
+    base_dir = Path(base_dir)
+    try:
+        stored = json.loads(Path(target).read_text(encoding='utf-8'))
+    except (FileNotFoundError, ValueError):
+        return {}
+    if stored.get('version') != DIGESTS_VERSION:
+        return {}
+    digests = {}
+    for path, recorded in stored['archives'].items():
+        try:
+            stat = (base_dir / path).stat()
+        except FileNotFoundError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) == (recorded['size'], recorded['mtime']):
+            digests[path] = recorded
+    return digests
+
+
+def write_digests(target, digests):
+    stored = {'version': DIGESTS_VERSION, 'archives': digests}
+    Path(target).write_text(json.dumps(stored), encoding='utf-8')
+
+
+def _match(names, pattern, index, source):
+    if any(c in pattern for c in '*?['):
+        return fnmatch.filter(names, pattern)
+    # Plain names are looked up directly
+    entry = index.get(pattern)
+    return [pattern] if entry is not None and entry.source == source.path else []
 
 
 @dataclass
@@ -42,11 +311,96 @@ class GameBase:
     patches: Optional[Sequence[str]]
     allowed_patches: Optional[Set[str]] = None
     restricted_patches: Optional[Set[str]] = None
-
+    cache: Optional[EntryCache] = None
+    level: str = DEFAULT_LEVEL
+    budget: Optional[float] = None
+    jobs: int = 1
+    append: bool = False
+    in_place: bool = False
+    max_open: int = DEFAULT_MAX_OPEN
+    index_path: Optional[str] = None
+
+    archives: ArchivePool = field(init=False)
     _patched: dict[tuple[str, str], bytes] = field(default_factory=dict)
+    _layers: dict[Path, MutableMapping[str, bytes]] = field(default_factory=dict)
+    _index: Optional[dict[str, GameEntry]] = None
+    _sources: list[GameSource] = field(default_factory=list)
+    _digests: Optional[dict[str, dict]] = None
+
+    def __post_init__(self) -> None:
+        self.archives = ArchivePool(self.max_open, self.cache)
+
+    def __enter__(self) -> 'GameBase':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.archives.close()
+
+    @property
+    def index_target(self) -> Path:
+        return Path(self.index_path) if self.index_path else Path(self.base_dir) / INDEX_NAME
+
+    def archive_digests(self, archive_path) -> dict[str, str]:
+        # Digests of the decoded entries, spare decoding originals to compare
+        if self._digests is None:
+            self._digests = load_digests(
+                self.base_dir, self.index_target.with_name(DIGESTS_NAME)
+            )
+        key = Path(archive_path).relative_to(self.base_dir).as_posix()
+        recorded = self._digests.get(key)
+        if recorded is None:
+            stat = Path(archive_path).stat()
+            recorded = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'entries': {}}
+            self._digests[key] = recorded
+        return recorded['entries']
+
+    @property
+    def index(self) -> dict[str, GameEntry]:
+        if self._index is None:
+            loaded = load_game_index(
+                self.base_dir,
+                self.index_target,
+                patches=self.patches,
+            )
+            if loaded is None:
+                loaded = index_game(self.base_dir, self.archives, patches=self.patches)
+            self._index, self._sources = loaded
+        return self._index
 
     def search(self, patterns):
-        return game_search(self.base_dir, patterns=patterns, patches=self.patches)
+        index = self.index
+        found = set()
+        # Patched entries are found before the game files they replace
+        patched = {alias: data for (_, alias), data in self._patched.items()}
+        for pattern in patterns:
+            for alias in fnmatch.filter(patched, pattern):
+                if alias not in found:
+                    found.add(alias)
+                    yield pattern, PatchedPath(alias, patched[alias])
+        for source in self._sources:
+            matches = []
+            for pattern in patterns:
+                for fname in _match(source.names, pattern, index, source):
+                    if fname not in found:
+                        found.add(fname)
+                        matches.append((pattern, fname))
+            if not matches:
+                continue
+            if not source.is_archive:
+                for pattern, fname in matches:
+                    yield pattern, source.path / fname
+                continue
+            layer = self._layers.get(source.path, {})
+            with self.archives.borrow(source.path) as archive:
+                files = self.archives.files(source.path, archive)
+                for pattern, fname in matches:
+                    if fname in layer:
+                        yield pattern, PatchedPath(fname, layer[fname])
+                    else:
+                        yield pattern, files[fname]
 
     def patch(self, fname: str, data: bytes, alias: str | None = None):
         if not alias:
@@ -58,44 +412,208 @@ class GameBase:
             return
         self._patched[(fname, alias)] = data
 
+    def patch_archive(self, archive_path, entries: MutableMapping[str, bytes]):
+        self._layers[Path(archive_path)] = entries
+
+    @contextmanager
+    def allowing(self, allowed_patches=()):
+        previous = self.allowed_patches
+        self.allowed_patches = set(allowed_patches)
+        try:
+            yield self
+        finally:
+            self.allowed_patches = previous
+
     def rebuild(self, target='.'):
         target = Path(target)
         os.makedirs(target, exist_ok=True)
+        index = self.index
         patches = defaultdict(dict)
+        added = {}
         for (fname, alias), data in self._patched.items():
             print(f'should patch {fname} as {alias}')
-            for pattern, entry in self.search([fname]):
-                if isinstance(entry, Path):
-                    (target / alias).write_bytes(data)
-                else:
-                    print(
-                        f'Patch {fname} as {alias} in {Path(entry.archive._filename).name}'
-                    )
-                    patches[Path(entry.archive._filename).name][alias] = data
-                break
+            if fname in index:
+                archive_path = index[fname].archive
+            elif fname in added:
+                # Patched again by a later step under its new name
+                archive_path = added[fname]
             else:
                 raise ValueError(f'entry {fname} was not found in game')
-        for arc, patch in patches.items():
-            for pattern, entry in self.search([arc]):
-                with stk.open(entry) as archive:
-                    recompress_archive(archive, patch, target / entry.name)
-                break
+            if alias not in index:
+                added[alias] = archive_path
+            if archive_path is None:
+                (target / alias).write_bytes(data)
             else:
-                raise ValueError(f'archive {arc} was not found')
+                print(f'Patch {fname} as {alias} in {archive_path.name}')
+                patches[archive_path][alias] = data
+        for archive_path, layer in self._layers.items():
+            if archive_path in patches:
+                # Merged lazily, files of the layer are read when written
+                patches[archive_path] = ChainMap(patches[archive_path], layer)
+            else:
+                patches[archive_path] = layer
+
+        # Archives may be rewritten in place
+        self.close()
+
+        # Every archive is written by its own thread, the compression of all
+        # of them shares a single process pool
+        pool = ProcessPoolExecutor(self.jobs or None) if self.jobs != 1 else None
+        writers = ThreadPoolExecutor(max(len(patches), 1))
+        with pool or nullcontext(), writers:
+            futures = [
+                writers.submit(
+                    self._rebuild_archive,
+                    archive_path,
+                    patch,
+                    target / archive_path.name,
+                    pool,
+                    self.archive_digests(archive_path),
+                )
+                for archive_path, patch in patches.items()
+            ]
+            for future in futures:
+                future.result()
+        if self.in_place:
+            # Digests of rewritten archives no longer match their entries
+            for archive_path in patches:
+                self._digests.pop(Path(archive_path).relative_to(self.base_dir).as_posix())
+        if self._digests is not None and self.index_target.exists():
+            write_digests(self.index_target.with_name(DIGESTS_NAME), self._digests)
+        self._index = None
+
+    def _rebuild_archive(
+        self, archive_path, patches, target, executor=None, digests=None
+    ):
+        # Archive handles are not shared between threads
+        with stk.open(archive_path, cache=self.cache) as archive:
+            self.write_archive(archive, patches, target, executor, digests)
+
+    def write_archive(self, archive, patches, target, executor=None, digests=None):
+        options = {
+            'level': self.level,
+            'budget': self.budget,
+            'jobs': self.jobs,
+            'cache': self.cache,
+            'executor': executor,
+            'digests': digests,
+        }
+        if self.in_place:
+            target = Path(archive._filename)
+        # STK v1 indexes cannot grow without moving every payload
+        appendable = archive.version == 2.1 or all(
+            fname in archive.index for fname in patches
+        )
+        if (self.append or self.in_place) and appendable:
+            append_archive(archive, patches, target, **options)
+        else:
+            recompress_archive(archive, patches, target, **options)
+
+
+@contextmanager
+def game_step(game, base_dir, rebuild=False, allowed_patches=(), **options):
+    # Steps sharing a game leave the rebuild to whoever opened it
+    if game is not None:
+        with game.allowing(allowed_patches):
+            yield game
+        return
+    with open_game(base_dir, allowed_patches=allowed_patches, **options) as game:
+        yield game
+        if rebuild:
+            game.rebuild()
 
 
 def open_game(
     base_dir,
     patches=(),
     allowed_patches=(),
+    cache=None,
+    level=DEFAULT_LEVEL,
+    budget=None,
+    jobs=1,
+    append=False,
+    in_place=False,
+    max_open=DEFAULT_MAX_OPEN,
+    index_path=None,
 ):
     return GameBase(
         base_dir,
         patches=patches,
         allowed_patches=set(allowed_patches),
+        cache=cache,
+        level=level,
+        budget=budget,
+        jobs=jobs,
+        append=append,
+        in_place=in_place,
+        max_open=max_open,
+        index_path=index_path,
+    )
+
+
+def add_cache_options(parser):
+    parser.add_argument(
+        '--cache',
+        help='directory for caching decompressed archive entries and compressed payloads between runs',
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=DEFAULT_MAX_SIZE >> 20,
+        help='maximum size of the cache directory in MiB',
+    )
+    parser.add_argument(
+        '--index',
+        help=f'game index to load, as written by the index command (defaults to {INDEX_NAME} in the game directory)',
     )
 
 
+def add_rebuild_options(parser):
+    add_cache_options(parser)
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='number of worker processes for extraction and compression (0 uses all cores)',
+    )
+    parser.add_argument(
+        '--level',
+        choices=COMPRESSION_LEVELS,
+        default=DEFAULT_LEVEL,
+        help='compression level for modified archive entries',
+    )
+    parser.add_argument(
+        '--budget',
+        type=float,
+        help='seconds allowed for compressing a single entry before falling back to fast',
+    )
+    parser.add_argument(
+        '--append',
+        action='store_true',
+        help='append modified entries to a copy of each archive instead of rewriting it',
+    )
+    parser.add_argument(
+        '--in-place',
+        action='store_true',
+        help='append modified entries to the original game archives',
+    )
+
+
+def game_options(args):
+    # Arguments of `open_game` from the options added above
+    options = {
+        name: getattr(args, name)
+        for name in ('jobs', 'level', 'budget', 'append', 'in_place')
+        if hasattr(args, name)
+    }
+    options['cache'] = (
+        EntryCache(args.cache, max_size=args.cache_size << 20) if args.cache else None
+    )
+    options['index_path'] = args.index
+    return options
+
+
 class DirectoryBackedArchive(MutableMapping[str, bytes]):
     def __init__(self, directory: str | Path, allowed: Iterable[str] = ()) -> None:
         self.directory = Path(directory)
@@ -124,38 +642,200 @@ class DirectoryBackedArchive(MutableMapping[str, bytes]):
     def __len__(self) -> int:
         return len(set(iter(self)))
 
+    def __contains__(self, key: object) -> bool:
+        return key in self._cache or (key in self._allowed and key not in self._popped)
+
     def __delitem__(self, key: str) -> None:
         self._cache.pop(key, None)
         self._popped.add(key)
 
 
-def extract_archive(game, extract_dir, patterns=ARCHIVE_PATTERNS):
-    for pattern, entry in game.search(patterns):
-        base_archive = entry.name
-        ext_archive = extract_dir / base_archive
-        os.makedirs(ext_archive, exist_ok=True)
-        with stk.open(entry) as archive:
-            for file in archive:
-                (ext_archive / file.name).write_bytes(file.read_bytes())
-                # print(
-                #     file.name,
-                #     int(archive.index[file.name].compression),
-                # )
+def _write_file(target, data):
+    # Returns the digest recorded in the manifest for the written file
+    target.write_bytes(data)
+    return hashlib.sha1(data).hexdigest()
+
+
+def _extract_entry(archive_path, entry, target, keep=False):
+    data = stk.read_entry(archive_path, entry)
+    # Only sent back when the parent stores it in the entry cache
+    return _write_file(target, data), data if keep else None
+
+
+def _file_digest(path):
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+
+def _load_manifest(extract_dir):
+    try:
+        manifest = json.loads((extract_dir / MANIFEST_NAME).read_text(encoding='utf-8'))
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['archives']
+
+
+def write_manifest(extract_dir, archive_paths, digests):
+    # Records the extracted files as written, to tell which were edited later.
+    # `digests` holds those of the files just written, only others are read.
+    archives = _load_manifest(extract_dir)
+    for archive_path in archive_paths:
+        files = {}
+        for path in sorted((extract_dir / archive_path.name).iterdir()):
+            stat = path.stat()
+            files[path.name] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'sha1': digests.get(path) or _file_digest(path),
+            }
+        stat = archive_path.stat()
+        archives[archive_path.name] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'files': files,
+        }
+    manifest = {'version': MANIFEST_VERSION, 'archives': archives}
+    (extract_dir / MANIFEST_NAME).write_text(json.dumps(manifest), encoding='utf-8')
+
+
+def unchanged_files(extract_dir, archive_path):
+    # Nothing is trusted once the game archive differs from the extracted one
+    recorded = _load_manifest(extract_dir).get(archive_path.name)
+    if recorded is None:
+        return set()
+    stat = archive_path.stat()
+    if (stat.st_size, stat.st_mtime_ns) != (recorded['size'], recorded['mtime']):
+        return set()
+    unchanged = set()
+    for fname, stamp in recorded['files'].items():
+        path = extract_dir / archive_path.name / fname
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if stat.st_size != stamp['size']:
+            continue
+        # Touched files are only read when their size still matches
+        if stat.st_mtime_ns == stamp['mtime'] or _file_digest(path) == stamp['sha1']:
+            unchanged.add(fname)
+    return unchanged
+
+
+def extract_archive(
+    game,
+    extract_dir,
+    patterns=ARCHIVE_PATTERNS,
+    jobs=1,
+    link_aliases=False,
+):
+    pool = ProcessPoolExecutor(jobs or None) if jobs != 1 else None
+    with pool or nullcontext():
+        tasks = []
+        chunked = []
+        aliased = []
+        extracted = []
+        digests = {}
+        for pattern, entry in game.search(patterns):
+            if isinstance(entry, Path):
+                extracted.append(entry)
+            base_archive = entry.name
+            ext_archive = extract_dir / base_archive
+            os.makedirs(ext_archive, exist_ok=True)
+            with stk.open(entry, mapped=True, cache=game.cache) as archive:
+                aliases = archive.aliases
+                for file in archive:
+                    if file.name in aliases:
+                        # Written from the first entry sharing the same payload
+                        aliased.append(
+                            (ext_archive / aliases[file.name], ext_archive / file.name)
+                        )
+                        continue
+                    target = ext_archive / file.name
+                    if pool is None or not isinstance(entry, Path):
+                        try:
+                            digests[target] = _write_file(
+                                target, archive.read_buffer(file.name)
+                            )
+                        except Exception as exc:
+                            if pool is not None:
+                                pool.shutdown(cancel_futures=True)
+                            raise ValueError(
+                                f'failed to extract {file.name} from {base_archive}'
+                            ) from exc
+                        continue
+                    index_entry = archive.index[file.name]
+                    # The cache is only used from this process, the pool just decodes
+                    key = None
+                    if game.cache is not None and index_entry.compression:
+                        key = archive.cache_key(index_entry)
+                        data = game.cache.get(key)
+                        if data is not None:
+                            digests[target] = _write_file(target, data)
+                            continue
+                    if index_entry.compression == 2:
+                        # Split across the pool by chunk once every entry is queued
+                        future = Future()
+                        chunked.append((future, entry, index_entry, target, key))
+                    else:
+                        future = pool.submit(
+                            _extract_entry, entry, index_entry, target, key is not None
+                        )
+                    tasks.append((base_archive, target, future, key))
+
+        for future, archive_path, index_entry, target, key in chunked:
+            try:
+                data = stk.read_entry(archive_path, index_entry, pool)
+                digest = _write_file(target, data)
+                if key is not None:
+                    game.cache.put(key, data)
+            except Exception as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result((digest, None))
+
+        # Report failures in index order, regardless of which worker failed first
+        for base_archive, target, future, key in tasks:
+            try:
+                digests[target], data = future.result()
+            except Exception as exc:
+                pool.shutdown(cancel_futures=True)
+                raise ValueError(
+                    f'failed to extract {target.name} from {base_archive}'
+                ) from exc
+            if data is not None:
+                game.cache.put(key, data)
+
+    for source, target in aliased:
+        if source in digests:
+            digests[target] = digests[source]
+        if link_aliases:
+            target.unlink(missing_ok=True)
+            try:
+                os.link(source, target)
+                continue
+            except OSError:
+                # Filesystems without hard links, or across devices
+                pass
+        shutil.copyfile(source, target)
+
+    write_manifest(extract_dir, extracted, digests)
 
 
 def rebuild_archive(game, extract_dir, patterns=ARCHIVE_PATTERNS):
-    patch_dir = Path('.')
-    os.makedirs(patch_dir, exist_ok=True)
     for pattern, entry in game.search(patterns):
         base_archive = entry.name
         ext_archive = extract_dir / base_archive
         if ext_archive.is_dir():
+            # Files left as extracted keep the stored payload of the original
+            unchanged = set()
+            if isinstance(entry, Path):
+                unchanged = unchanged_files(extract_dir, entry)
             patches = DirectoryBackedArchive(
                 ext_archive,
-                allowed={x.name for x in ext_archive.iterdir()},
+                allowed={x.name for x in ext_archive.iterdir()} - unchanged,
             )
-            with stk.open(entry) as archive:
-                recompress_archive(archive, patches, patch_dir / entry.name)
+            game.patch_archive(entry, patches)
 
 
 def menu():
@@ -175,6 +855,12 @@ def menu():
         action='store_true',
         help='create modifed game resource with the changes',
     )
+    parser.add_argument(
+        '--link-aliases',
+        action='store_true',
+        help='extract entries sharing the same payload as hard links',
+    )
+    add_rebuild_options(parser)
     return parser.parse_args()
 
 
@@ -182,18 +868,36 @@ def main(
     gamedir,
     rebuild,
     patterns=ARCHIVE_PATTERNS,
+    link_aliases=False,
+    game=None,
+    **options,
 ):
     extract_dir = Path('extracted')
     os.makedirs(extract_dir, exist_ok=True)
 
-    game = open_game(gamedir)
-    if not rebuild:
-        extract_archive(game, extract_dir, patterns=patterns)
-    else:
-        rebuild_archive(game, extract_dir, patterns=patterns)
+    with game_step(game, gamedir, rebuild, **options) as game:
+        if not rebuild:
+            extract_archive(
+                game,
+                extract_dir,
+                patterns=patterns,
+                jobs=game.jobs,
+                link_aliases=link_aliases,
+            )
+        else:
+            rebuild_archive(game, extract_dir, patterns=patterns)
 
 
 if __name__ == '__main__':
     args = menu()
 
-    main(args.directory, args.rebuild, args.patterns)
+    options = game_options(args)
+    main(
+        args.directory,
+        args.rebuild,
+        args.patterns,
+        link_aliases=args.link_aliases,
+        **options,
+    )
+    if options['cache']:
+        print(options['cache'])
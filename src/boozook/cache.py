@@ -0,0 +1,110 @@
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+import threading
+from typing import NamedTuple
+
+
+DEFAULT_MAX_SIZE = 1 << 30
+
+
+class ArchiveStamp(NamedTuple):
+    path: str
+    size: int
+    mtime: int
+
+
+def stamp_archive(path: str | os.PathLike) -> ArchiveStamp:
+    stat = os.stat(path)
+    return ArchiveStamp(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class EntryCache:
+    def __init__(self, directory: str | Path, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._usage: int | None = None
+        # Archives are written from several threads sharing one cache
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __str__(self) -> str:
+        return f'cache {self.directory}: {self.hits} hits, {self.misses} misses'
+
+    @staticmethod
+    def key(stamp: ArchiveStamp, offset: int, size: int, compression: int) -> str:
+        raw = f'{stamp.path}|{stamp.size}|{stamp.mtime}|{offset}|{size}|{int(compression)}'
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def content_key(data: bytes, mode: str) -> str:
+        # Derived outputs, such as compressed payloads, keyed by their input
+        digest = hashlib.sha1(mode.encode('utf-8') + b'\0')
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        path = self.directory / key
+        try:
+            data = path.read_bytes()
+            # Access time is tracked through mtime, as atime is often disabled
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_size:
+            return
+        path = self.directory / key
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                stream.write(data)
+            with self._lock:
+                # An entry written again replaces the size of the previous one
+                try:
+                    replaced = path.stat().st_size
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(temp, path)
+                self._usage = (
+                    self._scan_usage()
+                    if self._usage is None
+                    else self._usage + len(data) - replaced
+                )
+                if self._usage > self.max_size:
+                    self._evict()
+        except BaseException:
+            Path(temp).unlink(missing_ok=True)
+            raise
+
+    def _scan_usage(self) -> int:
+        return sum(
+            entry.stat().st_size
+            for entry in self.directory.iterdir()
+            if entry.suffix != '.tmp'
+        )
+
+    def _evict(self) -> None:
+        # Files still being written by other threads are left alone
+        entries = sorted(
+            (stat.st_mtime_ns, stat.st_size, entry)
+            for entry in self.directory.iterdir()
+            if entry.suffix != '.tmp'
+            for stat in [entry.stat()]
+        )
+        usage = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if usage <= self.max_size:
+                break
+            entry.unlink(missing_ok=True)
+            usage -= size
+        self._usage = usage
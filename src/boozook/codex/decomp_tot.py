@@ -9,7 +9,7 @@ from boozook.codex import tot
 from boozook.codex.crypt import CodePageEncoder, HebrewKeyReplacer
 from boozook.codex.ext import read_ext_table
 from boozook.codex.let import read_sint16le
-from boozook.codex.stk import replace_many, unpack_chunk
+from boozook.codex.stk import decode_lzss, replace_many
 from boozook.text import decrypt
 
 from boozook.totfile import (
@@ -17,7 +17,6 @@ from boozook.totfile import (
     read_uint16le,
     read_uint32le,
     reads_uint16le,
-    reads_uint32le,
 )
 
 
@@ -1143,22 +1142,14 @@ def read_ext_item(items, index, ext_data, com_data):
         if com_data is None:
             raise ValueError('No commun data')
         # TODO: handle different COMMUN.EX file for different TOTs
-        with io.BytesIO(com_data) as cstream:
-            assert ~offset == -(offset + 1)
-            cstream.seek(~offset)
-            if packed:
-                uncompressed_size = reads_uint32le(cstream)
-                return unpack_chunk(cstream, uncompressed_size)
-            else:
-                return cstream.read(size)
+        assert ~offset == -(offset + 1)
+        data, offset = com_data, ~offset
     else:
-        with io.BytesIO(ext_data) as stream:
-            stream.seek(offset)
-            if packed:
-                uncompressed_size = reads_uint32le(stream)
-                return unpack_chunk(stream, uncompressed_size)
-            else:
-                return stream.read(size)
+        data = ext_data
+    if packed:
+        uncompressed_size = read_uint32le(data[offset : offset + 4])
+        return decode_lzss(data, uncompressed_size, offset + 4)[0]
+    return data[offset : offset + size]
 
 
 def menu():
@@ -1189,14 +1180,13 @@ def menu():
         action='store_true',
         help='only decompile exported functions',
     )
+    archive.add_cache_options(parser)
 
 
     return parser.parse_args()
 
 
-def main(gamedir, rebuild, scripts, lang=None, keys=False, exported=False):
-    game = archive.open_game(gamedir)
-
+def decompile(game, rebuild, scripts, lang=None, keys=False, exported=False):
     decoders = defaultdict(lambda: CodePageEncoder('cp850'))
     decoders['ISR'] = CodePageEncoder('windows-1255')
     decoders['KOR'] = CodePageEncoder('utf-8', errors='surrogateescape')
@@ -1273,9 +1263,24 @@ def main(gamedir, rebuild, scripts, lang=None, keys=False, exported=False):
                         print()
 
 
+def main(
+    gamedir,
+    rebuild,
+    scripts,
+    lang=None,
+    keys=False,
+    exported=False,
+    game=None,
+    **options,
+):
+    with archive.game_step(game, gamedir, **options) as game:
+        decompile(game, rebuild, scripts, lang, keys, exported)
+
+
 if __name__ == '__main__':
     args = menu()
 
+    options = archive.game_options(args)
     main(
         args.directory,
         False,
@@ -1283,4 +1288,7 @@ if __name__ == '__main__':
         args.lang,
         args.keys,
         args.exported,
+        **options,
     )
+    if options['cache']:
+        print(options['cache'])
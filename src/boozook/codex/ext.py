@@ -1,3 +1,4 @@
+from functools import partial
 import io
 import itertools
 from pathlib import Path
@@ -8,8 +9,8 @@ from PIL import Image
 from boozook.archive import GameBase
 
 from pakal.archive import ArchivePath
-from boozook.codex.stk import unpack_chunk
-from boozook.codex.stk_compress import pack_content
+from boozook.codex.stk import decode_lzss, unpack_chunk
+from boozook.codex.stk_compress import DEFAULT_LEVEL, pack_cached
 from boozook.grid import convert_to_pil_image
 
 from boozook.totfile import read_tot, reads_uint32le
@@ -80,14 +81,13 @@ def unpack_sprite(data, width, height):
 
 
 def uncompress_sprite(data, width, height):
-    with io.BytesIO(data) as stream:
-        codec = stream.read(1)[0]
-        if codec != 1:
-            raise NotImplementedError(codec)
+    codec = data[0]
+    if codec != 1:
+        raise NotImplementedError(codec)
 
-        uncompressed_size = reads_uint32le(stream)
-        assert uncompressed_size == width * height
-        return list(unpack_chunk(stream, uncompressed_size))
+    uncompressed_size = read_uint32le(data[1:5])
+    assert uncompressed_size == width * height
+    return list(decode_lzss(data, uncompressed_size, 5)[0])
 
 
 # def uncompress_sprite(data, width, height):
@@ -260,9 +260,9 @@ def parse(game: GameBase, entry: ArchivePath, target: str | Path):
                     print(len(data), len(im))
 
 
-def compress_sprite(data):
+def compress_sprite(data, level=DEFAULT_LEVEL, budget=None, cache=None):
     data = bytes(data)
-    out = b'\x01\x02\x01' + pack_content(data)
+    out = b'\x01\x02\x01' + pack_cached(data, level, budget, cache)
 
     size = int.from_bytes(out[3:7], byteorder='little', signed=False)
     reunpacked = bytes(
@@ -382,12 +382,17 @@ def compose(game: GameBase, entry: ArchivePath, target: str | Path):
                     if len(im_data) != width * height:
                         raise ValueError(len(im_data), width * height)
                     data = {
-                        'UNCOMPRESS': compress_sprite,
+                        'UNCOMPRESS': partial(
+                            compress_sprite,
+                            level=game.level,
+                            budget=game.budget,
+                            cache=game.cache,
+                        ),
                         'UNPACK': pack_sprite,
                     }[im_type](im_data)
 
                 if packed:
-                    data = pack_content(data)
+                    data = pack_cached(data, game.level, game.budget, game.cache)
                 outdata += data
                 outfile += b''.join(
                     [
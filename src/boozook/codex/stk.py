@@ -1,15 +1,44 @@
+import bisect
+from concurrent.futures import Executor
 from datetime import datetime
 import io
+import itertools
+import mmap
+import os
+import struct
 from contextlib import contextmanager
-from typing import IO, TYPE_CHECKING, AnyStr, Iterator, NamedTuple, Tuple, cast
-
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    AnyStr,
+    Iterator,
+    Mapping,
+    NamedTuple,
+    Sequence,
+    Tuple,
+    cast,
+)
+
+import numpy as np
 from pakal.archive import BaseArchive, make_opener
-from pakal.examples.common import read_uint16_le, read_uint32_le, safe_readcstr
+from pakal.examples.common import read_uint16_le, read_uint32_le
 from pakal.stream import PartialStreamView
 
+from boozook.cache import ArchiveStamp, stamp_archive
+from boozook.codex.base import BufferLike
+
 if TYPE_CHECKING:
     from pakal.archive import ArchiveIndex
 
+    from boozook.cache import EntryCache
+
+
+STK_DATE_FORMAT = '%d%m%Y%H%M%S'
+
+
+def format_date(date: datetime) -> bytes:
+    return date.strftime(STK_DATE_FORMAT).encode('ascii')
+
 
 class STKFileEntry(NamedTuple):
     offset: int
@@ -22,11 +51,114 @@ class STK21FileEntry(NamedTuple):
     size: int
     compression: int
     uncompressed_size: int
-    modified: datetime
-    created: datetime
-    creator: str
+    raw_modified: bytes
+    raw_created: bytes
+    raw_creator: bytes
     unk: bytes
 
+    @property
+    def modified(self) -> datetime:
+        return datetime.strptime(self.raw_modified.decode(), STK_DATE_FORMAT)
+
+    @property
+    def created(self) -> datetime:
+        return datetime.strptime(self.raw_created.decode(), STK_DATE_FORMAT)
+
+    @property
+    def creator(self) -> str:
+        return self.raw_creator.split(b'\0')[0].decode()
+
+
+STK_RECORD = np.dtype(
+    [
+        ('name', 'V13'),
+        ('size', '<u4'),
+        ('offset', '<u4'),
+        ('compression', 'u1'),
+    ]
+)
+
+STK21_RECORD = np.dtype(
+    [
+        ('name_offset', '<u4'),
+        ('modified', 'V14'),
+        ('created', 'V14'),
+        ('creator', 'V8'),
+        ('size', '<u4'),
+        ('uncompressed_size', '<u4'),
+        ('unk', 'V5'),
+        ('offset', '<u4'),
+        ('compression', '<u4'),
+    ]
+)
+
+
+class STKIndex(Mapping[str, STKFileEntry | STK21FileEntry]):
+    def __init__(
+        self,
+        names: Sequence[str],
+        table: np.ndarray,
+        compression: np.ndarray,
+    ) -> None:
+        # Later records win over earlier ones with the same name, as with dict()
+        self._positions = {name: idx for idx, name in enumerate(names)}
+        self._table = table
+        self._offsets = table['offset']
+        self._sizes = table['size']
+        self._compression = compression
+        self._aliases: dict[str, str] | None = None
+
+    def __getitem__(self, fname: str) -> STKFileEntry | STK21FileEntry:
+        idx = self._positions[fname]
+        offset = int(self._offsets[idx])
+        size = int(self._sizes[idx])
+        compression = int(self._compression[idx])
+        if self._table.dtype != STK21_RECORD:
+            return STKFileEntry(offset, size, compression)
+        record = self._table[idx]
+        return STK21FileEntry(
+            offset,
+            size,
+            compression,
+            int(record['uncompressed_size']),
+            record['modified'].tobytes(),
+            record['created'].tobytes(),
+            record['creator'].tobytes(),
+            record['unk'].tobytes(),
+        )
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._positions)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, fname: object) -> bool:
+        return fname in self._positions
+
+    def position(self, fname: str) -> int:
+        # Index of the record for `fname` in the archive index
+        return self._positions[fname]
+
+    @property
+    def aliases(self) -> dict[str, str]:
+        # Maps each name sharing its payload with an earlier entry to that entry
+        if self._aliases is None:
+            keys = list(
+                zip(
+                    self._offsets.tolist(),
+                    self._sizes.tolist(),
+                    self._compression.tolist(),
+                )
+            )
+            first: dict[tuple[int, int, int], str] = {}
+            self._aliases = {}
+            for fname, idx in self._positions.items():
+                canonical = first.setdefault(keys[idx], fname)
+                if canonical != fname:
+                    self._aliases[fname] = canonical
+        return self._aliases
+
 
 def replace_many(s: AnyStr, *reps: Tuple[AnyStr, AnyStr]) -> AnyStr:
     for r in reps:
@@ -34,105 +166,332 @@ def replace_many(s: AnyStr, *reps: Tuple[AnyStr, AnyStr]) -> AnyStr:
     return s
 
 
-def extract_stk21(stream):
+def extract_stk21(stream: IO[bytes]) -> STKIndex:
     _date = stream.read(14)
     _creator = stream.read(8)
     file_names_offset = read_uint32_le(stream)
     stream.seek(file_names_offset)
     file_count = read_uint32_le(stream)
     misc_offset = read_uint32_le(stream)
-    for cpt in range(file_count):
-        stream.seek(misc_offset + cpt * 61)
-        filename_offset = read_uint32_le(stream)
-        modified = datetime.strptime(stream.read(14).decode(), '%d%m%Y%H%M%S')
-        created = datetime.strptime(stream.read(14).decode(), '%d%m%Y%H%M%S')
-        creator = stream.read(8).split(b'\0')[0].decode()
-        size = read_uint32_le(stream)
-        uncompressed_size = read_uint32_le(stream)
-        unk = stream.read(5)
-        offset = read_uint32_le(stream)
-        compression = read_uint32_le(stream)
-        stream.seek(filename_offset)
-        file_name = safe_readcstr(stream).decode()
-        yield file_name, STK21FileEntry(offset, size, compression, uncompressed_size, modified, created, creator, unk)
-
-
-def extract(stream: IO[bytes]) -> Iterator[Tuple[str, STKFileEntry]]:
+    stream.seek(misc_offset)
+    records = stream.read(file_count * STK21_RECORD.itemsize)
+    if len(records) != file_count * STK21_RECORD.itemsize:
+        raise EOFError(f'Expected {file_count} index records but reached EOF')
+    table = np.frombuffer(records, dtype=STK21_RECORD)
+
+    name_offsets = table['name_offset']
+    names_start = int(name_offsets.min()) if file_count else misc_offset
+    stream.seek(names_start)
+    if names_start < misc_offset and int(name_offsets.max()) < misc_offset:
+        names_data = stream.read(misc_offset - names_start)
+    else:
+        names_data = stream.read()
+
+    names = []
+    for name_offset in name_offsets.tolist():
+        start = name_offset - names_start
+        end = names_data.find(b'\0', start)
+        if end < 0:
+            raise EOFError('Expected null-termination but reached EOF')
+        names.append(names_data[start:end].decode())
+    return STKIndex(names, table, table['compression'])
+
+
+def extract(stream: IO[bytes]) -> STKIndex:
     file_count = read_uint16_le(stream)
-    for _i in range(file_count):
-        raw_fname = stream.read(13)
+    records = stream.read(file_count * STK_RECORD.itemsize)
+    if len(records) != file_count * STK_RECORD.itemsize:
+        raise EOFError(f'Expected {file_count} index records but reached EOF')
+    table = np.frombuffer(records, dtype=STK_RECORD)
+    compression = (table['compression'] != 0).astype(np.uint8)
+
+    # Replacing cyrillic characters
+    reps = ('\x85', 'E'), ('\x8A', 'K'), ('\x8E', 'O'), ('\x91', 'C'), ('\x92', 'T')
+
+    names = []
+    for idx, raw_fname in enumerate(table['name'].tolist()):
         file_name = raw_fname.split(b'\0')[0].decode()
-        size = read_uint32_le(stream)
-        offset = read_uint32_le(stream)
-        # assert offset % 2 == 0, offset
-        compression = stream.read(1) != b'\00'
         if file_name.upper().endswith('.0OT'):
-            compression = 2
+            compression[idx] = 2
             file_name = file_name.replace('.0OT', '.TOT')
-
-        # Replacing cyrillic characters
-        reps = ('\x85', 'E'), ('\x8A', 'K'), ('\x8E', 'O'), ('\x91', 'C'), ('\x92', 'T')
-        file_name = replace_many(file_name, *reps)
-
-        yield file_name, STKFileEntry(offset, size, compression)
-
-
-def unpack_chunk(stream: IO[bytes], size: int) -> bytes:
-    buffer_index = 4078
-    buffer = bytearray(b'\x20' * buffer_index + b'\0' * 36)
-    result = b''
-
-    command = 0
-    while True:
+        names.append(replace_many(file_name, *reps))
+    return STKIndex(names, table, compression)
+
+
+WINDOW_SIZE = 4096
+
+# The decoder dictionary laid out in output order: the 4096 bytes preceding the
+# first output byte, ring positions 0..4077 are spaces. The engine leaves ring
+# positions 4078..4095 uninitialised, they are zeroed here only to decode
+# deterministically and the encoder never references them.
+INITIAL_WINDOW = b'\0' * 18 + b'\x20' * 4078
+
+
+def _decode_lzss(
+    data: BufferLike,
+    pos: int,
+    limit: int,
+    out: bytearray,
+    k: int,
+    stop: int,
+    end: int,
+    skew: int,
+    command: int,
+) -> Tuple[int, int, int]:
+    # Decodes into `out` from index `k` until `stop` is reached or the input
+    # position passes `limit`. A back-reference may run past `stop` but never
+    # past `end`. The ring position of `out[k]` is `(k - skew) % WINDOW_SIZE`.
+    while k < stop and pos < limit:
         command >>= 1
         if command & 0x0100 == 0:
-            command = ord(stream.read(1)) | 0xFF00
+            command = data[pos] | 0xFF00
+            pos += 1
 
         if command & 1 != 0:
-            temp = stream.read(1)
-            result += temp
-            buffer[buffer_index] = ord(temp)
-            buffer_index += 1
-            buffer_index %= 4096
-            size -= 1
-            if not size:
-                break
+            out[k] = data[pos]
+            pos += 1
+            k += 1
         else:
-            hi, low = stream.read(2)
+            hi, low = data[pos], data[pos + 1]
+            pos += 2
 
             offset = hi | ((low & 0xF0) << 4)
-            length = (low & 0x0F) + 3
+            length = min((low & 0x0F) + 3, end - k)
+
+            distance = (k - skew - offset) % WINDOW_SIZE or WINDOW_SIZE
+            src = k - distance
+            if distance >= length:
+                out[k : k + length] = out[src : src + length]
+            else:
+                pattern = out[src:k]
+                out[k : k + length] = (pattern * (length // distance + 1))[:length]
+            k += length
 
-            for i in range(length):
-                result += bytes([buffer[(offset + i) % 4096]])
-                size -= 1
-                if not size:
-                    return bytes(result)
+    return pos, k, command
 
-                buffer[buffer_index] = buffer[(offset + i) % 4096]
-                buffer_index += 1
-                buffer_index %= 4096
 
-    return bytes(result)
+def decode_lzss(data: BufferLike, size: int, pos: int = 0) -> Tuple[bytes, int]:
+    out = bytearray(WINDOW_SIZE + size)
+    out[:WINDOW_SIZE] = INITIAL_WINDOW
+    end = len(out)
+    try:
+        pos, k, _ = _decode_lzss(data, pos, len(data), out, WINDOW_SIZE, end, end, 18, 0)
+    except IndexError:
+        k = -1
+    if k < end:
+        raise EOFError(f'Compressed data ended before {size} bytes were decoded')
+    return bytes(memoryview(out)[WINDOW_SIZE:]), pos
 
 
-def unpack_chunks(view):
+def unpack_chunk(stream: IO[bytes], size: int) -> bytes:
+    pos = stream.tell()
+    if isinstance(stream, io.BytesIO):
+        with stream.getbuffer() as data:
+            result, end = decode_lzss(data, size, pos)
+    else:
+        result, end = decode_lzss(stream.read(), size)
+        end += pos
+    stream.seek(end)
+    return result
+
+
+def scan_chunks(stream: IO[bytes]) -> list[Tuple[int, int]]:
+    chunks = []
     chunk_size = 0
-    data = bytearray()
-    uncompressed_size = 0
     while chunk_size != 0xFFFF:
-        pos = view.tell()
-        chunk_size = read_uint16_le(view)
-        real_size = read_uint16_le(view)
-        uncompressed_size += real_size
-
+        pos = stream.tell()
+        chunk_size = read_uint16_le(stream)
+        real_size = read_uint16_le(stream)
         assert chunk_size >= 4
-        view.read(2)
-        data += unpack_chunk(view, real_size)
+        chunks.append((pos + 6, real_size))
         if chunk_size != 0xFFFF:
-            assert view.tell() == pos + chunk_size + 2
-    assert len(data) == uncompressed_size
-    return bytes(data)
+            stream.seek(pos + chunk_size + 2)
+    return chunks
+
+
+def find_chunks(data: BufferLike) -> list[Tuple[int, int]]:
+    chunks = []
+    pos = 0
+    chunk_size = 0
+    while chunk_size != 0xFFFF:
+        chunk_size, real_size = struct.unpack_from('<2H', data, pos)
+        assert chunk_size >= 4
+        chunks.append((pos + 6, real_size))
+        pos += chunk_size + 2
+    return chunks
+
+
+def chunk_spans(data: BufferLike) -> list[Tuple[memoryview, int]]:
+    chunks = find_chunks(data)
+    ends = [offset - 6 for offset, _ in chunks[1:]] + [len(data)]
+    view = memoryview(data)
+    return [(view[offset:end], size) for (offset, size), end in zip(chunks, ends)]
+
+
+def unpack_chunks(data: BufferLike, executor: Executor | None = None) -> bytes:
+    # Each chunk starts with a fresh dictionary, so they can be decoded apart
+    chunks = chunk_spans(data)
+    spans = [span for span, _ in chunks]
+    sizes = [size for _, size in chunks]
+    if executor is not None and len(chunks) > 1:
+        results = executor.map(decode_lzss, [bytes(span) for span in spans], sizes)
+    else:
+        results = map(decode_lzss, spans, sizes)
+
+    out = bytearray(sum(sizes))
+    pos = 0
+    for idx, (chunk, consumed) in enumerate(results):
+        if idx + 1 < len(chunks):
+            assert consumed == len(spans[idx]), (consumed, len(spans[idx]))
+        out[pos : pos + len(chunk)] = chunk
+        pos += len(chunk)
+    return bytes(out)
+
+
+class LZSSReader(io.RawIOBase):
+    def __init__(
+        self,
+        stream: IO[bytes] | BufferLike,
+        chunks: Sequence[Tuple[int, int]],
+        block_size: int = 0x10000,
+    ) -> None:
+        super().__init__()
+        self._stream = stream
+        self._chunks = chunks
+        self._ends = list(itertools.accumulate(size for _, size in chunks))
+        self._size = self._ends[-1] if self._ends else 0
+        self._block_size = block_size
+        self._pos = 0
+
+        self._index = -1
+        self._chunk_start = 0
+        self._out = bytearray()
+        self._origin = 0
+        self._skew = 18
+        self._command = 0
+        self._data = b''
+        self._in = 0
+        self._in_base = 0
+        self._eof = False
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        elif whence != io.SEEK_SET:
+            raise ValueError(f'invalid whence ({whence})')
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        return offset
+
+    def readall(self) -> bytes:
+        # Past the end there is nothing left, and read(-1) would come back here
+        return b''.join(iter(lambda: self.read(max(0, self._size - self._pos)), b''))
+
+    def readinto(self, buffer) -> int:
+        pos = self._pos
+        if pos >= self._size or not len(buffer):
+            return 0
+        index = bisect.bisect_right(self._ends, pos)
+        if index != self._index or pos < max(self._chunk_start, -self._origin):
+            self._enter_chunk(index)
+        target = min(pos + len(buffer), self._ends[index])
+        self._decode_to(target)
+        count = target - pos
+        buffer[:count] = self._out[pos + self._origin : target + self._origin]
+        self._pos = target
+        return count
+
+    def _enter_chunk(self, index: int) -> None:
+        offset, size = self._chunks[index]
+        self._index = index
+        self._chunk_start = self._ends[index] - size
+        self._out = bytearray(INITIAL_WINDOW)
+        self._origin = WINDOW_SIZE - self._chunk_start
+        self._skew = 18
+        self._command = 0
+        if isinstance(self._stream, (bytes, bytearray, memoryview)):
+            # Decode straight from the buffer, there is nothing to refill
+            self._data = self._stream
+            self._in = offset
+            self._in_base = 0
+            self._eof = True
+            return
+        self._stream.seek(offset)
+        self._data = b''
+        self._in = 0
+        self._in_base = offset
+        self._eof = False
+
+    def _decode_to(self, target: int) -> None:
+        out = self._out
+        decoded = len(out) - self._origin
+        if target <= decoded:
+            return
+
+        # Keep the dictionary and any bytes not yet read, drop the rest
+        cut = min(self._pos, decoded - WINDOW_SIZE) + self._origin
+        if cut >= self._block_size:
+            del out[:cut]
+            self._origin -= cut
+            self._skew = (self._skew - cut) % WINDOW_SIZE
+
+        end = self._ends[self._index] + self._origin
+        k = decoded + self._origin
+        stop = target + self._origin
+        out.extend(bytes(min(stop + 18, end) - len(out)))
+        while k < stop:
+            if not self._eof and self._in >= len(self._data) - 2:
+                block = self._stream.read(self._block_size)
+                self._eof = not block
+                self._in_base += self._in
+                self._data = self._data[self._in :] + block
+                self._in = 0
+            limit = len(self._data) if self._eof else len(self._data) - 2
+            if self._eof and self._in >= limit:
+                raise EOFError(
+                    f'Compressed data ended after {k - self._origin} of {self._size} bytes'
+                )
+            try:
+                self._in, k, self._command = _decode_lzss(
+                    self._data,
+                    self._in,
+                    limit,
+                    out,
+                    k,
+                    stop,
+                    end,
+                    self._skew,
+                    self._command,
+                )
+            except IndexError:
+                # A command was cut short by the end of the compressed data
+                raise EOFError(
+                    f'Compressed data ended before {self._size} bytes were decoded'
+                ) from None
+        del out[k:]
+
+        if k == end and self._index + 1 < len(self._chunks):
+            next_offset, _ = self._chunks[self._index + 1]
+            assert self._in_base + self._in == next_offset - 6, (
+                self._in_base + self._in,
+                next_offset - 6,
+            )
 
 
 def unpack(stream: IO[bytes], offset: int, size: int, compression: int) -> IO[bytes]:
@@ -141,29 +500,189 @@ def unpack(stream: IO[bytes], offset: int, size: int, compression: int) -> IO[by
     if not compression:
         return view
     if compression == 2:
-        return io.BytesIO(unpack_chunks(view))
-    uncompressed_size = read_uint32_le(view)
-    return io.BytesIO(unpack_chunk(view, uncompressed_size))
+        chunks = scan_chunks(view)
+    else:
+        uncompressed_size = read_uint32_le(view)
+        chunks = [(view.tell(), uncompressed_size)]
+    return io.BufferedReader(LZSSReader(view, chunks))
+
+
+def unpack_buffer(data: BufferLike, compression: int) -> IO[bytes]:
+    if not compression:
+        return io.BytesIO(data)
+    if compression == 2:
+        chunks = find_chunks(data)
+    else:
+        (uncompressed_size,) = struct.unpack_from('<I', data)
+        chunks = [(4, uncompressed_size)]
+    return io.BufferedReader(LZSSReader(data, chunks))
+
+
+def decode_payload(
+    data: BufferLike,
+    compression: int,
+    executor: Executor | None = None,
+) -> bytes:
+    if not compression:
+        return bytes(data)
+    if compression == 2:
+        return unpack_chunks(data, executor=executor)
+    (uncompressed_size,) = struct.unpack_from('<I', data)
+    return decode_lzss(data, uncompressed_size, 4)[0]
+
+
+def read_entry(
+    path: str | os.PathLike,
+    entry: STKFileEntry | STK21FileEntry,
+    executor: Executor | None = None,
+) -> bytes:
+    with io.open(path, 'rb') as stream:
+        stream.seek(entry.offset)
+        data = decode_payload(stream.read(entry.size), entry.compression, executor)
+    if isinstance(entry, STK21FileEntry):
+        assert len(data) == entry.uncompressed_size, (len(data), entry.uncompressed_size)
+    return data
+
+
+# Decoded payloads shared by several names kept by an open archive
+MAX_SHARED_PAYLOADS = 8
 
 
 class STKArchive(BaseArchive[STKFileEntry | STK21FileEntry]):
+    def __init__(
+        self,
+        *args,
+        mapped: bool = False,
+        cache: 'EntryCache | None' = None,
+        **kwargs,
+    ) -> None:
+        self._mapped = mapped
+        self._mapping: mmap.mmap | None = None
+        self._exports: list[memoryview] = []
+        self._cache = cache
+        self._stamp: ArchiveStamp | None = None
+        self._shared_keys: set[tuple[int, int, int]] | None = None
+        # Ordered from least to most recently read
+        self._shared: dict[tuple[int, int, int], bytes] = {}
+        super().__init__(*args, **kwargs)
+
     def _create_index(self) -> 'ArchiveIndex[STKFileEntry | STK21FileEntry]':
         header = self._stream.read(6)
         if header == b'STK2.1':
             self.version = 2.1
-            return dict(extract_stk21(self._stream))
+            return extract_stk21(self._stream)
         self._stream.seek(0, io.SEEK_SET)
         self.version = 1
-        return dict(extract(self._stream))
+        return extract(self._stream)
+
+    def _view(self, entry: STKFileEntry | STK21FileEntry) -> memoryview | None:
+        if not self._mapped:
+            return None
+        if self._mapping is None:
+            try:
+                fileno = self._stream.fileno()
+            except (AttributeError, OSError):
+                # Not backed by a real file, fall back to stream reads
+                self._mapped = False
+                return None
+            self._mapping = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        with memoryview(self._mapping) as mapping:
+            return mapping[entry.offset : entry.offset + entry.size]
+
+    def read_raw(self, entry: STKFileEntry | STK21FileEntry) -> BufferLike:
+        view = self._view(entry)
+        if view is not None:
+            # Released when the archive is closed, so the mapping can be closed
+            self._exports.append(view)
+            return view
+        self._stream.seek(entry.offset)
+        return self._stream.read(entry.size)
+
+    def read_buffer(self, fname: str, executor: Executor | None = None) -> BufferLike:
+        entry = self.index[fname]
+        if not entry.compression:
+            return self.read_raw(entry)
+        if executor is not None and entry.compression == 2:
+            return decode_payload(self.read_raw(entry), entry.compression, executor)
+        with self._read_entry(entry) as stream:
+            return stream.read()
+
+    @property
+    def aliases(self) -> dict[str, str]:
+        return self.index.aliases
 
     @contextmanager
     def _read_entry(self, entry: STKFileEntry | STK21FileEntry) -> Iterator[IO[bytes]]:
-        res = unpack(self._stream, entry.offset, entry.size, entry.compression)
+        if entry.compression:
+            # Recently read payloads referenced by several names are kept decoded
+            key = entry[:3]
+            if key in self._shared_payloads():
+                data = self._shared.pop(key, None)
+                if data is None:
+                    data = self._read_decoded(entry)
+                self._shared[key] = data
+                while len(self._shared) > MAX_SHARED_PAYLOADS:
+                    del self._shared[next(iter(self._shared))]
+                yield io.BytesIO(data)
+                return
+            if self._cache is not None:
+                yield io.BytesIO(self._read_decoded(entry))
+                return
+        with self._decode_entry(entry) as res:
+            yield res
+
+    def _shared_payloads(self) -> set[tuple[int, int, int]]:
+        if self._shared_keys is None:
+            self._shared_keys = {
+                self.index[canonical][:3] for canonical in self.aliases.values()
+            }
+        return self._shared_keys
+
+    def _read_decoded(self, entry: STKFileEntry | STK21FileEntry) -> bytes:
+        if self._cache is None:
+            with self._decode_entry(entry) as res:
+                return res.read()
+        key = self.cache_key(entry)
+        data = self._cache.get(key)
+        if data is None:
+            with self._decode_entry(entry) as res:
+                data = res.read()
+            self._cache.put(key, data)
+        return data
+
+    def cache_key(self, entry: STKFileEntry | STK21FileEntry) -> str:
+        # Key of the decoded content of `entry` in the entry cache
+        if self._stamp is None:
+            self._stamp = stamp_archive(self._filename)
+        return self._cache.key(self._stamp, entry.offset, entry.size, entry.compression)
+
+    @contextmanager
+    def _decode_entry(self, entry: STKFileEntry | STK21FileEntry) -> Iterator[IO[bytes]]:
+        view = self._view(entry)
+        if view is not None:
+            res = unpack_buffer(view, entry.compression)
+        else:
+            res = unpack(self._stream, entry.offset, entry.size, entry.compression)
         if isinstance(entry, STK21FileEntry) and entry.uncompressed_size is not None:
             res.seek(0, io.SEEK_END)
             assert res.tell() == entry.uncompressed_size, (res.tell(), entry.uncompressed_size)
             res.seek(0, io.SEEK_SET)
-        yield res
+        try:
+            yield res
+        finally:
+            if view is not None:
+                view.release()
+
+    def close(self) -> None:
+        self._shared.clear()
+        if self._mapping is not None:
+            # Views handed out by read_raw can no longer be used afterwards
+            for view in self._exports:
+                view.release()
+            self._exports.clear()
+            self._mapping.close()
+            self._mapping = None
+        super().close()
 
 
 open = make_opener(STKArchive)
@@ -1,115 +1,256 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+from functools import partial
+import hashlib
 import io
+import itertools
+import os
+import shutil
+import struct
+import sys
 from pathlib import Path
+import time
+from typing import Iterable, Iterator, Tuple
+
+import numpy as np
+
 from boozook.codex.base import write_uint32_le
 
-from boozook.codex.stk import STK21FileEntry, STKFileEntry, unpack_chunk
+from boozook.codex.stk import (
+    INITIAL_WINDOW,
+    WINDOW_SIZE,
+    STKFileEntry,
+    chunk_spans,
+    decode_lzss,
+    format_date,
+)
 
 
-def check_dico(unpacked, unpacked_index, counter, dico, dico_index):
-    best_pos = 0
-    best_length = 2
+MIN_MATCH = 3
+MAX_MATCH = 18
 
-    if counter < 3:
-        return None
 
-    template = dico[:4096] + dico[:18]
+COMPRESSION_LEVELS = ('fast', 'balanced', 'optimal')
+DEFAULT_LEVEL = 'balanced'
 
-    for i in range(min(18, counter), 2, -1):
-        pattern = unpacked[unpacked_index : unpacked_index + i]
-        pos = template.find(pattern)
-        while pos != -1:
-            if not (pos < dico_index <= pos + i - 1):
-                assert 0 <= pos < 4096
-                best_pos = pos
-                best_length = i
-                return (True, best_pos, best_length)
-            pos = template.find(pattern, pos + 1)
+LITERAL_BITS = 9
+MATCH_BITS = 17
 
-    return (False, best_pos, 0)
+# Chunk sizes are read as signed 16-bit values, so a chunk of incompressible
+# data, at 9 bits per byte, has to stay below 0x7FFF bytes
+CHUNK_SIZE = 0x7000
+LAST_CHUNK = 0xFFFF
 
 
-def pack_content(data):
-    with io.BytesIO() as output:
-        dico_index = 4078
-        dico = bytearray(b'\x20' * dico_index + b'\x20' * 36)
-        write_buffer = bytearray(17)
-
-        size = len(data)
-        unpacked = data + b'\0'
-
-        output.write(size.to_bytes(4, byteorder='little', signed=False))
-
-        dico[dico_index : dico_index + 3] = unpacked[:3]
-        dico_index += 3
-
-        write_buffer[1] = unpacked[0]
-        write_buffer[2] = unpacked[1]
-        write_buffer[3] = unpacked[2]
-
-        cmd = (1 << 3) - 1
-        counter = size - 3
-        unpacked_index = 3
-        cpt = 3
-        buff_index = 4
-
-        size = 4
-        resultcheckpos = 0
-        resultchecklength = 0
-
-        while counter > 0:
-            cdico = False
-            checked = check_dico(unpacked, unpacked_index, counter, dico, dico_index)
-            if checked is not None:
-                cdico, resultcheckpos, resultchecklength = checked
-            if not cdico:
-                dico[dico_index] = unpacked[unpacked_index]
-                write_buffer[buff_index] = unpacked[unpacked_index]
-                cmd |= 1 << cpt
-                unpacked_index += 1
-                dico_index = (dico_index + 1) % 4096
-                buff_index += 1
-                counter -= 1
-            else:
-                for i in range(resultchecklength):
-                    dico[((dico_index + i) % 4096)] = dico[
-                        ((resultcheckpos + i) % 4096)
-                    ]
-
-                write_buffer[buff_index] = resultcheckpos & 0xFF
-                write_buffer[buff_index + 1] = ((resultcheckpos & 0x0F00) >> 4) + (
-                    resultchecklength - 3
-                )
+class BudgetExceeded(Exception):
+    pass
 
-                unpacked_index += resultchecklength
-                dico_index = (dico_index + resultchecklength) % 4096
-                resultcheckpos = (resultcheckpos + resultchecklength) % 4096
 
-                buff_index += 2
-                counter -= resultchecklength
+# The engine only fills ring positions 0..4077 with spaces before decoding,
+# so the 18 bytes at the start of `buf` (ring 4078..4095) are never referenced
+FIRST_SOURCE = 18
 
-            if cpt == 7 or counter == 0:
-                write_buffer[0] = cmd
-                output.write(write_buffer[:buff_index])
-                size += buff_index
-                buff_index = 1
-                cmd = 0
-                cpt = 0
-            else:
-                cpt += 1
 
-        with io.BytesIO(output.getbuffer()) as packed:
-            size = int.from_bytes(packed.read(4), byteorder='little', signed=False)
-            reunpacked = unpack_chunk(
-                packed,
-                size,
-            )
-            if data != reunpacked:
-                print(data[:100])
-                print(reunpacked[:100])
-                print(reunpacked[:100] == data[:100])
-            assert data == reunpacked
-        return output.getvalue()
+# Earlier positions tried for a match at every position, nearest first
+CHAIN_DEPTH = {
+    'fast': 1,
+    'balanced': 64,
+    'optimal': 256,
+}
+
+
+def chain_links(buf: bytes) -> list[int]:
+    # Previous position of the 3-byte sequence starting at every position, or
+    # -1 where there is none. A stable sort groups equal sequences in order.
+    data = np.frombuffer(buf, dtype=np.uint8).astype(np.int32)
+    count = max(len(buf) - MIN_MATCH + 1, 0)
+    keys = (data[:count] << 16) | (data[1 : count + 1] << 8) | data[2 : count + 2]
+    order = np.argsort(keys, kind='stable')
+    same = keys[order[1:]] == keys[order[:-1]]
+    prev = np.full(len(buf), -1, dtype=np.int64)
+    prev[order[1:][same]] = order[:-1][same]
+    return prev.tolist()
+
+
+class MatchFinder:
+    def __init__(self, buf: bytes, depth: int) -> None:
+        self.buf = buf
+        self.end = len(buf)
+        self.depth = depth
+        self._prev = chain_links(buf)
+
+    def find(self, k: int) -> Tuple[int, int]:
+        # Walks the hash chain of `k` for the longest match, keeping the
+        # nearest source among equally long ones. A match may overlap the
+        # bytes it produces, so the source only has to start before `k`.
+        prev = self._prev
+        candidate = prev[k]
+        lo = max(k - WINDOW_SIZE, FIRST_SOURCE)
+        if candidate < lo:
+            return 0, 0
+
+        buf = self.buf
+        max_length = min(MAX_MATCH, self.end - k)
+        target = int.from_bytes(buf[k : k + max_length], 'big')
+        best, src = 0, 0
+        for _ in range(self.depth):
+            # Only a candidate matching the byte past the best match can beat it
+            if buf[candidate + best] == buf[k + best]:
+                # The first differing byte ends the match
+                source = int.from_bytes(buf[candidate : candidate + max_length], 'big')
+                length = max_length - ((target ^ source).bit_length() + 7) // 8
+                if length > best:
+                    best, src = length, candidate
+                    if length == max_length:
+                        break
+            candidate = prev[candidate]
+            if candidate < lo:
+                break
+        return best, src
+
+
+def _check_deadline(deadline: float | None) -> None:
+    if deadline is not None and time.perf_counter() > deadline:
+        raise BudgetExceeded
+
+
+def parse_fast(finder: MatchFinder, deadline: float | None) -> Iterator[Tuple[int, int]]:
+    k = WINDOW_SIZE
+    while k < finder.end:
+        length, src = finder.find(k)
+        yield length, src
+        k += length or 1
+
+
+def parse_balanced(
+    finder: MatchFinder, deadline: float | None
+) -> Iterator[Tuple[int, int]]:
+    # Greedy longest match, deferred by one byte when the next position has a
+    # longer one
+    k = WINDOW_SIZE
+    ahead = None
+    # Matches step over positions, so the deadline is checked past thresholds
+    next_check = k
+    while k < finder.end:
+        if k >= next_check:
+            _check_deadline(deadline)
+            next_check = k + 0x1000
+        length, src = ahead or finder.find(k)
+        ahead = None
+        if MIN_MATCH <= length < MAX_MATCH and k + 1 < finder.end:
+            ahead = finder.find(k + 1)
+            if ahead[0] > length:
+                length = 0
+        if length < MIN_MATCH:
+            yield 0, 0
+            k += 1
+        else:
+            ahead = None
+            yield length, src
+            k += length
+
+
+def parse_optimal(
+    finder: MatchFinder, deadline: float | None
+) -> Iterator[Tuple[int, int]]:
+    count = finder.end - WINDOW_SIZE
+    matches = []
+    for i in range(count):
+        if not i % 0x1000:
+            _check_deadline(deadline)
+        matches.append(finder.find(WINDOW_SIZE + i))
+
+    # Cheapest encoding of every suffix, in bits. A match found at a position
+    # can be cut to any shorter length from the same source.
+    cost = [0] * (count + 1)
+    choice = [0] * count
+    for i in range(count - 1, -1, -1):
+        best = LITERAL_BITS + cost[i + 1]
+        pick = 0
+        longest = matches[i][0]
+        if longest:
+            # Ties go to the longest match
+            tail = cost[i + MIN_MATCH : i + longest + 1]
+            cheapest = min(tail)
+            if MATCH_BITS + cheapest <= best:
+                best = MATCH_BITS + cheapest
+                pick = MIN_MATCH + len(tail) - 1 - tail[::-1].index(cheapest)
+        cost[i] = best
+        choice[i] = pick
+
+    i = 0
+    while i < count:
+        length = choice[i]
+        yield length, matches[i][1] if length else 0
+        i += length or 1
+
+
+PARSERS = {
+    'fast': parse_fast,
+    'balanced': parse_balanced,
+    'optimal': parse_optimal,
+}
+
+
+def encode_ops(buf: bytes, size: int, ops: Iterable[Tuple[int, int]]) -> bytes:
+    output = bytearray(write_uint32_le(size))
+    k = WINDOW_SIZE
+    cmd_pos = 0
+    for bit, (length, src) in zip(itertools.cycle(range(8)), ops):
+        if bit == 0:
+            cmd_pos = len(output)
+            output.append(0)
+        if length < MIN_MATCH:
+            output[cmd_pos] |= 1 << bit
+            output.append(buf[k])
+            k += 1
+        else:
+            offset = (src - 18) % WINDOW_SIZE
+            output.append(offset & 0xFF)
+            output.append(((offset >> 4) & 0xF0) | (length - MIN_MATCH))
+            k += length
+    return bytes(output)
+
+
+def pack_level(data, level=DEFAULT_LEVEL, budget=None):
+    # Returns the packed content and the level it was packed at, which falls
+    # back to fast when `level` takes over `budget` seconds
+    size = len(data)
+    # Positions in `buf` are shifted by the initial dictionary, so the ring
+    # position of `buf[k]` is `(k - 18) % WINDOW_SIZE`.
+    buf = INITIAL_WINDOW + bytes(data)
+    deadline = None if budget is None else time.perf_counter() + budget
+    finder = MatchFinder(buf, CHAIN_DEPTH[level])
+    try:
+        output = encode_ops(buf, size, PARSERS[level](finder, deadline))
+    except BudgetExceeded:
+        level = 'fast'
+        finder.depth = CHAIN_DEPTH[level]
+        output = encode_ops(buf, size, parse_fast(finder, None))
+
+    reunpacked, _ = decode_lzss(output, size, 4)
+    assert data == reunpacked
+    return output, level
+
+
+def keep_packed(result, level, budget, cache=None, key=None):
+    # Payloads packed fast for lack of budget are not cached, so later runs
+    # try the requested level again
+    packed, packed_level = result
+    if packed_level != level:
+        print(
+            f'compression took over {budget}s at level {level}, packed fast',
+            file=sys.stderr,
+        )
+    elif cache is not None:
+        cache.put(key, packed)
+    return packed
+
+
+def pack_content(data, level=DEFAULT_LEVEL, budget=None):
+    return keep_packed(pack_level(data, level, budget), level, budget)
 
 
 def write_header(index):
@@ -129,11 +270,253 @@ def write_header(index):
         return output.getvalue()
 
 
-def recompress_archive(archive, patches, target, force_recompress=False):
+def pack_cached(data, level=DEFAULT_LEVEL, budget=None, cache=None):
+    if cache is None:
+        return pack_content(data, level, budget)
+    key = cache.content_key(data, f'lzss:{level}')
+    packed = cache.get(key)
+    if packed is None:
+        packed = keep_packed(pack_level(data, level, budget), level, budget, cache, key)
+    return packed
+
+
+def plan_chunks(data, previous, chunk_size=CHUNK_SIZE):
+    # Splits `data` to chunks, reusing the stored bytes of `previous` chunks
+    # at the start and end of the content that are still the same
+    head = []
+    pos = 0
+    for span, decoded in previous:
+        if data[pos : pos + len(decoded)] != decoded:
+            break
+        head.append((decoded, span))
+        pos += len(decoded)
+    tail = []
+    end = len(data)
+    for span, decoded in reversed(previous[len(head) :]):
+        if end - len(decoded) < pos or data[end - len(decoded) : end] != decoded:
+            break
+        tail.append((decoded, span))
+        end -= len(decoded)
+    middle = [
+        (data[i : min(i + chunk_size, end)], None) for i in range(pos, end, chunk_size)
+    ]
+    return head + middle + tail[::-1] or [(b'', None)]
+
+
+def join_chunks(chunks, filler=b'\0\0'):
+    output = bytearray()
+    for idx, (span, size) in enumerate(chunks):
+        chunk_size = LAST_CHUNK if idx + 1 == len(chunks) else len(span) + 4
+        assert chunk_size < 0x7FFF or chunk_size == LAST_CHUNK, chunk_size
+        output += struct.pack('<2H', chunk_size, size) + filler + span
+    return bytes(output)
+
+
+def submit_chunks(pool, data, level, budget, cache=None, original=None):
+    previous = []
+    filler = b'\0\0'
+    chunk_size = CHUNK_SIZE
+    if original is not None:
+        raw, decoded = original
+        spans = chunk_spans(raw)
+        pos = 0
+        for idx, (span, size) in enumerate(spans):
+            if idx + 1 == len(spans):
+                # The last chunk runs to the end of the entry, padding included,
+                # and may be reused before other chunks
+                span = span[: decode_lzss(span, size)[1]]
+            previous.append((bytes(span), decoded[pos : pos + size]))
+            pos += size
+        filler = bytes(raw[4:6])
+        # New chunks are no larger than the ones the game already reads
+        largest = max(len(chunk) for _, chunk in previous)
+        chunk_size = min(chunk_size, largest or chunk_size)
+
+    jobs = []
+    for piece, span in plan_chunks(data, previous, chunk_size):
+        if span is not None:
+            jobs.append((len(piece), partial(bytes, span), 0))
+        else:
+            job = submit_payload(pool, piece, 1, level, budget, cache)
+            # Chunks do not repeat the size header of single stream payloads
+            jobs.append((len(piece), job, 4))
+
+    def produce():
+        return join_chunks(
+            [(job()[skip:], size) for size, job, skip in jobs], filler
+        )
+
+    return produce
+
+
+def submit_payload(
+    pool, data, compression, level, budget, cache=None, original=None
+):
+    # Returns a callable producing the stored payload of `data`, `original`
+    # holds the stored and decoded content it replaces, if any
+    if not compression:
+        return partial(bytes, data)
+    if compression == 2:
+        return submit_chunks(pool, data, level, budget, cache, original)
+    if pool is None:
+        return partial(pack_cached, data, level, budget, cache)
+
+    # The cache is only used from this process, the pool just compresses
+    key = None
+    if cache is not None:
+        key = cache.content_key(data, f'lzss:{level}')
+        packed = cache.get(key)
+        if packed is not None:
+            return partial(bytes, packed)
+    future = pool.submit(pack_level, data, level, budget)
+
+    def produce():
+        return keep_packed(future.result(), level, budget, cache, key)
+
+    return produce
+
+
+def compare_original(file, data, digests=None):
+    # Returns whether `data` matches the stored content and the decoded
+    # original when it had to be decoded, known digests spare the decoding
+    known = digests.get(file.name) if digests is not None else None
+    if known is not None:
+        return hashlib.sha1(data).hexdigest() == known, None
+    orig_data = file.read_bytes()
+    if digests is not None:
+        digests[file.name] = hashlib.sha1(orig_data).hexdigest()
+    return orig_data == data, orig_data
+
+
+def added_entry(archive, template, offset, size):
+    if archive.version != 2.1:
+        return STKFileEntry(offset, size, False)
+    return template._replace(
+        offset=offset,
+        size=size,
+        compression=False,
+        uncompressed_size=size,
+        # TODO: Allow setting modified date and creator
+        raw_modified=format_date(datetime.now()),
+        raw_creator=b'Boozook',
+    )
+
+
+def write_stk21_trailer(output, index, base):
+    filename_offset = output.tell() + 8
+    first_name_offset = filename_offset
+    misc = bytearray()
+    names = bytearray()
+    for fname, entry in index.items():
+        misc += write_uint32_le(filename_offset)
+        names += fname.encode('ascii') + b'\0'
+        filename_offset += len(fname) + 1
+        misc += (
+            entry.raw_modified
+            + entry.raw_created
+            + entry.raw_creator.ljust(8, b'\0')[:8]
+        )
+        misc += write_uint32_le(entry.size)
+        misc += write_uint32_le(entry.uncompressed_size)
+        misc += entry.unk
+        misc += write_uint32_le(entry.offset + base)
+        misc += write_uint32_le(entry.compression)
+    output.write(write_uint32_le(len(index)) + write_uint32_le(first_name_offset + len(names)) + names + misc)
+
+
+def write_payload(output, content, base, padded, stored=None):
+    # Identical payloads are written once, `stored` maps their digest to the offset
+    if stored is not None:
+        digest = hashlib.sha1(content).digest()
+        if digest in stored:
+            return stored[digest]
+    offset = output.tell() - base
+    output.write(content)
+    if len(content) % 2 and padded:
+        output.write(b'\0')
+    if stored is not None:
+        stored[digest] = offset
+    return offset
+
+
+@contextmanager
+def replacing(target, archive=None):
+    # Written beside the target and moved over it at the end, as the target
+    # may be the archive being read. That archive is closed first, open files
+    # cannot be replaced on Windows.
+    temp = target.with_name(target.name + '.tmp')
+    try:
+        with temp.open('wb') as output:
+            yield output
+    except BaseException:
+        temp.unlink(missing_ok=True)
+        raise
+    if archive is not None and target.exists() and target.samefile(archive._filename):
+        archive.close()
+    os.replace(temp, target)
+
+
+def recompress_archive(
+    archive,
+    patches,
+    target,
+    force_recompress=False,
+    level=DEFAULT_LEVEL,
+    budget=None,
+    jobs=1,
+    cache=None,
+    executor=None,
+    digests=None,
+):
     target = Path(target)
     index = {}
     orig_offs = {}
-    with io.BytesIO() as output:
+    names = [file.name for file in archive]
+    # Patches are only read, they may be backed by files read on access
+    added = [fname for fname in patches if fname not in archive.index]
+    count = len(names) + len(added)
+    padded = archive.version != 2.1
+    # The header is reserved up front and filled in once every offset is known
+    base = 32 if archive.version == 2.1 else 22 * count + 2
+    own_pool = None
+    if executor is None and jobs != 1:
+        own_pool = ProcessPoolExecutor(jobs or None)
+    pool = executor or own_pool
+    # Entries are prepared this far ahead of the one being written, so the pool
+    # compresses while writing without holding every patch in memory
+    window = 2 * (jobs or os.cpu_count() or 1) if pool is not None else 0
+
+    def keep(file):
+        # Untouched entries are copied as stored, without decoding them
+        entry = archive.index[file.name]
+        return getattr(entry, 'uncompressed_size', None), partial(archive.read_raw, entry)
+
+    def prepare(file, compression):
+        # Returns the uncompressed size of the entry and a callable producing
+        # its stored payload
+        if file.name in patches:
+            patch_data = patches[file.name]
+        else:
+            # Only reached when every entry is recompressed
+            patch_data = file.read_bytes()
+        unchanged, orig_data = False, None
+        if not force_recompress:
+            unchanged, orig_data = compare_original(file, patch_data, digests)
+        if unchanged:
+            # Skip files that should stay the same as packing the content takes long time
+            return len(patch_data), partial(archive.read_raw, archive.index[file.name])
+        original = None
+        if compression == 2 and not force_recompress:
+            if orig_data is None:
+                orig_data = file.read_bytes()
+            original = archive.read_raw(archive.index[file.name]), orig_data
+        produce = submit_payload(
+            pool, patch_data, compression, level, budget, cache, original
+        )
+        return len(patch_data), produce
+
+    def queue():
+        queued = set()
         for file in archive:
             compression = archive.index[file.name].compression
             print(
@@ -141,81 +524,168 @@ def recompress_archive(archive, patches, target, force_recompress=False):
                 int(compression),
                 archive.index[file.name],
             )
-            orig_data = file.read_bytes()
-            patch_data = patches.pop(file.name, orig_data)
-            uncompressed_size = len(patch_data)
-            if orig_data != patch_data or force_recompress:
-                content = pack_content(patch_data) if compression else patch_data
+            if archive.index[file.name] in queued:
+                # Stored once, pointed to by the first entry sharing it
+                yield file, compression, None
+                continue
+            queued.add(archive.index[file.name])
+            if file.name not in patches and not force_recompress:
+                yield file, compression, partial(keep, file)
             else:
-                # Skip files that should stay the same as packing the content takes long time
-                with archive._read_entry(
-                    archive.index[file.name]._replace(compression=False) if archive.version != 2.1 else archive.index[file.name]._replace(compression=False, uncompressed_size=None)
-                ) as stream:
-                    content = stream.read()
+                yield file, compression, partial(prepare, file, compression)
+
+    def started():
+        ahead = deque()
+        for file, compression, prepare_entry in queue():
+            ahead.append((file, compression, prepare_entry and prepare_entry()))
+            if len(ahead) > window:
+                yield ahead.popleft()
+        yield from ahead
+
+    with own_pool or nullcontext(), replacing(target, archive) as output:
+        output.write(bytes(base))
+        stored = {}
+
+        # Written in index order as results arrive, so the output does not
+        # depend on which worker finishes first
+        for file, compression, prepared in started():
             dup = orig_offs.get(archive.index[file.name], None)
             if dup:
                 index[file.name] = dup
                 continue
-            fname = file.name if compression != 2 else file.with_suffix('.0OT').name
+            uncompressed_size, produce = prepared
+            content = produce()
+            fname = file.name
+            if compression == 2 and archive.version != 2.1:
+                # STK v1 marks chunked entries by name, STK2.1 has a compression field
+                fname = file.with_suffix('.0OT').name
+            offset = write_payload(output, content, base, padded, stored)
             index[fname] = (
-                STKFileEntry(output.tell(), len(content), compression)
+                STKFileEntry(offset, len(content), compression)
                 if archive.version != 2.1
                 else archive.index[file.name]._replace(
-                    offset=output.tell(),
+                    offset=offset,
                     size=len(content),
                     compression=compression,
                     uncompressed_size=uncompressed_size
                 )
             )
-            if len(content) % 2 and archive.version != 2.1:
-                content += b'\0'
-            output.write(content)
             orig_offs[archive.index[file.name]] = index[fname]
-        for fname, content in patches.items():
-            assert fname not in index, (list(index.keys()), list(patches.keys()))
-            index[fname] = (
-                STKFileEntry(output.tell(), len(content), False)
-                if archive.version != 2.1
-                else archive.index[file.name]._replace(
-                    offset=output.tell(),
-                    size=len(content),
-                    compression=False,
-                    uncompressed_size=uncompressed_size,
-                    # TODO: Allow setting modified date and creator
-                    modified=datetime.now(),
-                    creator='Boozook',
-                )
+        for fname in added:
+            assert fname not in index, (list(index.keys()), added)
+            content = patches[fname]
+            offset = write_payload(output, content, base, padded, stored)
+            index[fname] = added_entry(
+                archive, archive.index[file.name], offset, len(content)
             )
-            if len(content) % 2 and archive.version != 2.1:
-                content += b'\0'
-            output.write(content)
 
         # TODO: Allow preserve / modify
-        ctime = datetime.now().strftime('%d%m%Y%H%M%S').encode('ascii')
+        ctime = format_date(datetime.now())
         creator = 'Boozook'.ljust(8, '\0').encode('ascii')[:8]
 
         if archive.version == 2.1:
-            filename_offset = output.tell() + 32
-            header = b'STK2.1' + ctime + creator + write_uint32_le(filename_offset)
-            filename_offset += 8
-            first_name_offset = filename_offset
-            misc = bytearray()
-            names = bytearray()
-            for fname, entry in index.items():
-                misc += write_uint32_le(filename_offset)
-                names += fname.encode('ascii') + b'\0'
-                filename_offset += len(fname) + 1
-                misc += (
-                    entry.modified.strftime('%d%m%Y%H%M%S').encode('ascii')
-                    + entry.created.strftime('%d%m%Y%H%M%S').encode('ascii')
-                    + entry.creator.ljust(8, '\0').encode('ascii')[:8]
-                )
-                misc += write_uint32_le(entry.size)
-                misc += write_uint32_le(entry.uncompressed_size)
-                misc += entry.unk
-                misc += write_uint32_le(entry.offset + 32)
-                misc += write_uint32_le(entry.compression)
-            target.write_bytes(header + output.getvalue() + write_uint32_le(len(index)) + write_uint32_le(first_name_offset + len(names)) + names + misc)
-            return
-        header = write_header(index)
-        target.write_bytes(header + output.getvalue())
+            header = b'STK2.1' + ctime + creator + write_uint32_le(output.tell())
+            write_stk21_trailer(output, index, base)
+        else:
+            header = write_header(index)
+        assert len(header) == base, (len(header), base)
+        output.seek(0)
+        output.write(header)
+
+
+def append_archive(
+    archive,
+    patches,
+    target,
+    force_recompress=False,
+    level=DEFAULT_LEVEL,
+    budget=None,
+    jobs=1,
+    cache=None,
+    executor=None,
+    digests=None,
+):
+    target = Path(target)
+    source = Path(archive._filename)
+    names = [file.name for file in archive]
+    added = [fname for fname in patches if fname not in archive.index]
+    if added and archive.version != 2.1:
+        raise ValueError(f'cannot append new files to STK v1 archive: {added}')
+
+    own_pool = None
+    if executor is None and jobs != 1:
+        own_pool = ProcessPoolExecutor(jobs or None)
+    pool = executor or own_pool
+    with own_pool or nullcontext():
+        pending = []
+        for file in archive:
+            if file.name not in patches:
+                continue
+            entry = archive.index[file.name]
+            patch_data = patches[file.name]
+            orig_data = None
+            if not force_recompress:
+                unchanged, orig_data = compare_original(file, patch_data, digests)
+                if unchanged:
+                    continue
+            print(f'append {file.name}', int(entry.compression), entry)
+            original = None
+            if entry.compression == 2 and not force_recompress:
+                if orig_data is None:
+                    orig_data = file.read_bytes()
+                original = archive.read_raw(entry), orig_data
+            produce = submit_payload(
+                pool, patch_data, entry.compression, level, budget, cache, original
+            )
+            pending.append((file.name, len(patch_data), produce))
+        for fname in added:
+            content = patches[fname]
+            print(f'append new file {fname}')
+            pending.append((fname, len(content), partial(bytes, content)))
+
+        if not target.exists() or not target.samefile(source):
+            shutil.copyfile(source, target)
+
+        with target.open('r+b') as output:
+            # Written past the end of the archive, its index is only updated
+            # once every payload is, so an interrupted write leaves it intact
+            end = output.seek(0, io.SEEK_END)
+            try:
+                write_appended(archive, output, names, pending)
+            except BaseException:
+                output.truncate(end)
+                raise
+
+
+def write_appended(archive, output, names, pending):
+    if archive.version != 2.1 and output.tell() % 2:
+        output.write(b'\0')
+
+    index = {fname: archive.index[fname] for fname in names}
+    stored = {}
+    for fname, size, produce in pending:
+        content = produce()
+        offset = write_payload(output, content, 0, archive.version != 2.1, stored)
+        if fname in index:
+            index[fname] = index[fname]._replace(offset=offset, size=len(content))
+            if archive.version == 2.1:
+                index[fname] = index[fname]._replace(uncompressed_size=size)
+        else:
+            index[fname] = added_entry(archive, index[names[-1]], offset, size)
+
+    if archive.version == 2.1:
+        # The previous index is left behind, as the header still points to it
+        # until the new one is complete
+        trailer_offset = output.tell()
+        write_stk21_trailer(output, index, 0)
+        output.flush()
+        output.seek(28)
+        output.write(write_uint32_le(trailer_offset))
+        return
+
+    output.flush()
+    for fname, _, _ in pending:
+        # Only the size and offset of the record are rewritten
+        entry = index[fname]
+        output.seek(2 + 22 * archive.index.position(fname) + 13)
+        output.write(write_uint32_le(entry.size) + write_uint32_le(entry.offset))
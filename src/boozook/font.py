@@ -20,7 +20,6 @@ def encode(game, patterns, fonts_dir):
     for pattern, entry in game.search(patterns):
         _, _, compose = patterns[pattern]
         compose(game, entry, fonts_dir)
-    game.rebuild()
 
 
 def menu():
@@ -34,23 +33,27 @@ def menu():
         action='store_true',
         help='create modifed game resource with the changes',
     )
+    archive.add_rebuild_options(parser)
     return parser.parse_args()
 
 
-def main(gamedir, rebuild):
+def main(gamedir, rebuild, game=None, **options):
     patterns = FONT_PATTERNS
 
     fonts_dir = Path('fonts')
     os.makedirs(fonts_dir, exist_ok=True)
 
-    game = archive.open_game(gamedir)
-    if not rebuild:
-        decode(game, patterns, fonts_dir)
-    else:
-        encode(game, patterns, fonts_dir)
+    with archive.game_step(game, gamedir, rebuild, **options) as game:
+        if not rebuild:
+            decode(game, patterns, fonts_dir)
+        else:
+            encode(game, patterns, fonts_dir)
 
 
 if __name__ == '__main__':
     args = menu()
 
-    main(args.directory, args.rebuild)
+    options = archive.game_options(args)
+    main(args.directory, args.rebuild, **options)
+    if options['cache']:
+        print(options['cache'])
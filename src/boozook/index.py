@@ -0,0 +1,31 @@
+from boozook.archive import DIGESTS_NAME, INDEX_NAME, write_game_index
+
+
+def add_arguments(parser):
+    parser.add_argument('directory', help='game directory to index')
+    parser.add_argument(
+        '--output',
+        '-o',
+        help=f'index file to write (defaults to {INDEX_NAME} in the game directory)',
+    )
+
+
+def menu(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='write an index of game files')
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(gamedir, output=None):
+    target, scan = write_game_index(gamedir, output)
+    entries = sum(len(scanned['entries']) for scanned in scan['archives'])
+    print(f'indexed {len(scan["archives"])} archives with {entries} entries to {target}')
+    print(f'entry digests are kept in {target.with_name(DIGESTS_NAME)}')
+
+
+if __name__ == '__main__':
+    args = menu()
+
+    main(args.directory, args.output)
@@ -1,11 +1,11 @@
 import argparse
 import sys
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from operator import itemgetter
 import pathlib
 
 from prompt_toolkit import PromptSession
-from boozook import archive, font
+from boozook import archive, font, index
 from boozook import text
 from boozook import graphics
 from boozook.codex import decomp_tot
@@ -63,6 +63,8 @@ class ProgramArgs:
     gamedir: pathlib.Path
     resources: dict[str, dict]
     rebuild: bool
+    # Arguments of `archive.open_game`
+    options: dict = field(default_factory=dict)
 
 
 def interactive_menu(gamedir, experimental=False):
@@ -117,17 +119,36 @@ def menu(argv=None):
     if argv is None:
         argv = sys.argv[1:]
 
+    # Options shared by the game steps and the index command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        '--experimental',
+        action='store_true',
+        help='Enable experimental features.',
+    )
+
     parser = argparse.ArgumentParser(
-        description='A tool to modify Coktel Vision games.'
+        description='A tool to modify Coktel Vision games.',
+        epilog='"%(prog)s index DIRECTORY" writes an index of game files, '
+        'see "%(prog)s index -h".',
+        parents=[common],
     )
 
     experimental = '--experimental' in argv
 
-    parser.add_argument(
-        '--experimental',
-        action='store_true',
-        help='Enable experimental features.',
-    )
+    # The index command takes the place of the game directory, after any
+    # common options. A game directory named like it is given as ./index.
+    _, rest = common.parse_known_args(argv)
+    if rest[:1] == ['index']:
+        command = argparse.ArgumentParser(
+            prog=f'{parser.prog} index',
+            description='Write an index of game files.',
+            parents=[common],
+        )
+        command.set_defaults(command='index')
+        index.add_arguments(command)
+        pos = argv.index('index')
+        return command.parse_args(argv[:pos] + argv[pos + 1 :])
 
     parser.add_argument(
         'path',
@@ -211,6 +232,8 @@ def menu(argv=None):
         action='store_true',
         help='Rebuild or inject resources.',
     )
+
+    archive.add_rebuild_options(parser)
     args = parser.parse_args(argv)
 
     gamedir = pathlib.Path(args.path)
@@ -218,6 +241,8 @@ def menu(argv=None):
     options = vars(args)
     options.pop('path')
 
+    game_options = archive.game_options(args)
+
     if options.get('scripts') == []:
         options['scripts'] = ['*.TOT']
 
@@ -225,7 +250,9 @@ def menu(argv=None):
     if experimental:
         features += ('scripts',)
     if not any(itemgetter(*features)(options)):
-        return interactive_menu(gamedir, experimental=experimental)
+        program = interactive_menu(gamedir, experimental=experimental)
+        program.options = game_options
+        return program
 
     # Options given, run non-interactively
     resources = {}
@@ -251,30 +278,38 @@ def menu(argv=None):
         gamedir=gamedir,
         resources=resources,
         rebuild=args.rebuild,
+        options=game_options,
     )
 
 
 def main():
     args = menu()
-
-    gamedir = args.gamedir
-
-    for resource, advanced in args.resources.items():
-        if resource == 'archive':
-            archive.main(gamedir, args.rebuild, **advanced)
-        elif resource == 'fonts':
-            font.main(gamedir, args.rebuild, **advanced)
-        elif resource == 'texts':
-            text.main(gamedir, args.rebuild, **advanced)
-        elif resource == 'graphics':
-            graphics.main(gamedir, args.rebuild, **advanced)
-        elif resource == 'scripts':
-            decomp_tot.main(gamedir, args.rebuild, **advanced)
-        else:
-            raise ValueError(repr(resource))
+    if getattr(args, 'command', None) == 'index':
+        index.main(args.directory, args.output)
+        return
+
+    # Every step works on the same game, later steps see the patches of
+    # earlier ones and each archive is written once at the end
+    with archive.open_game(args.gamedir, **args.options) as game:
+        for resource, advanced in args.resources.items():
+            if resource == 'archive':
+                archive.main(args.gamedir, args.rebuild, game=game, **advanced)
+            elif resource == 'fonts':
+                font.main(args.gamedir, args.rebuild, game=game, **advanced)
+            elif resource == 'texts':
+                text.main(args.gamedir, args.rebuild, game=game, **advanced)
+            elif resource == 'graphics':
+                graphics.main(args.gamedir, args.rebuild, game=game, **advanced)
+            elif resource == 'scripts':
+                decomp_tot.main(args.gamedir, args.rebuild, game=game, **advanced)
+            else:
+                raise ValueError(repr(resource))
 
         if args.rebuild:
-            gamedir = pathlib.Path('.')
+            game.rebuild()
+
+    if args.options.get('cache'):
+        print(args.options['cache'])
 
 
 if __name__ == '__main__':
@@ -65,7 +65,6 @@ def encode(game, patterns, texts_dir, crypts):
         with open(text_file, 'r', encoding='utf-8') as text_stream:
             tsv_reader = csv.DictReader(text_stream, delimiter='\t')
             composer(game, encrypt_texts(crypts, tsv_reader))
-    game.rebuild()
 
 
 def menu():
@@ -91,10 +90,11 @@ def menu():
         action='store_true',
         help='replace text by keyboard key position',
     )
+    archive.add_rebuild_options(parser)
     return parser.parse_args()
 
 
-def main(gamedir, rebuild, allowed=(), keys=False):
+def main(gamedir, rebuild, allowed=(), keys=False, game=None, **options):
     patterns = TEXT_PATTERNS
 
     texts_dir = Path('texts')
@@ -107,19 +107,25 @@ def main(gamedir, rebuild, allowed=(), keys=False):
     if keys:
         decoders['ISR'] = HebrewKeyReplacer
 
-    game = archive.open_game(gamedir, allowed_patches=allowed or ())
-    if not rebuild:
-        decode(game, patterns, texts_dir, decoders)
-    else:
-        encode(game, patterns, texts_dir, decoders)
+    with archive.game_step(
+        game, gamedir, rebuild, allowed_patches=allowed or (), **options
+    ) as game:
+        if not rebuild:
+            decode(game, patterns, texts_dir, decoders)
+        else:
+            encode(game, patterns, texts_dir, decoders)
 
 
 if __name__ == '__main__':
     args = menu()
 
+    options = archive.game_options(args)
     main(
         args.directory,
         args.rebuild,
         allowed=args.allowed,
         keys=args.keys,
+        **options,
     )
+    if options['cache']:
+        print(options['cache'])
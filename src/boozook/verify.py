@@ -0,0 +1,177 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+import io
+import os
+from pathlib import Path
+import sys
+import time
+from typing import NamedTuple
+
+from boozook.archive import ARCHIVE_PATTERNS
+from boozook.codex import stk
+
+
+class EntryReport(NamedTuple):
+    archive: str
+    name: str
+    offset: int
+    size: int
+    compression: int
+    decoded_size: int | None
+    seconds: float
+    error: str | None
+
+
+def find_archives(base_dir, patterns=ARCHIVE_PATTERNS):
+    base_dir = Path(base_dir)
+    # Extracted archives are directories named after the archive
+    return sorted(
+        {
+            path
+            for pattern in patterns
+            for path in base_dir.rglob(pattern)
+            if path.is_file()
+        }
+    )
+
+
+def check_bounds(entry, file_size):
+    if entry.offset + entry.size > file_size:
+        return f'entry ends at {entry.offset + entry.size} past end of file ({file_size})'
+    if isinstance(entry, stk.STK21FileEntry) and not entry.compression:
+        if entry.size != entry.uncompressed_size:
+            return f'stored size {entry.size} != declared {entry.uncompressed_size}'
+    return None
+
+
+def verify_entry(archive_path, name, entry):
+    start = time.perf_counter()
+    decoded_size = None
+    try:
+        with io.open(archive_path, 'rb') as stream:
+            stream.seek(entry.offset)
+            data = stream.read(entry.size)
+        if len(data) != entry.size:
+            raise EOFError(f'read {len(data)} of {entry.size} bytes')
+        decoded_size = len(stk.decode_payload(data, entry.compression))
+        if isinstance(entry, stk.STK21FileEntry):
+            if decoded_size != entry.uncompressed_size:
+                raise ValueError(
+                    f'decoded {decoded_size} bytes, declared {entry.uncompressed_size}'
+                )
+        error = None
+    except Exception as exc:
+        error = f'{type(exc).__name__}: {exc}'
+    return EntryReport(
+        Path(archive_path).name,
+        name,
+        entry.offset,
+        entry.size,
+        int(entry.compression),
+        decoded_size,
+        time.perf_counter() - start,
+        error,
+    )
+
+
+def verify_game(base_dir, index_only=False, jobs=0, patterns=ARCHIVE_PATTERNS):
+    with ProcessPoolExecutor(jobs or None) as pool:
+        pending = []
+        for archive_path in find_archives(base_dir, patterns):
+            start = time.perf_counter()
+            file_size = os.path.getsize(archive_path)
+            try:
+                with stk.open(archive_path) as archive:
+                    index = {fname: archive.index[fname] for fname in archive.index}
+            except Exception as exc:
+                error = f'{type(exc).__name__}: {exc}'
+                elapsed = time.perf_counter() - start
+                report = EntryReport(archive_path.name, '', 0, 0, 0, None, elapsed, error)
+                pending.append(report)
+                continue
+
+            for fname, entry in index.items():
+                error = check_bounds(entry, file_size)
+                if index_only or error:
+                    report = EntryReport(
+                        archive_path.name,
+                        fname,
+                        entry.offset,
+                        entry.size,
+                        int(entry.compression),
+                        None,
+                        0.0,
+                        error,
+                    )
+                    pending.append(report)
+                    continue
+                pending.append(pool.submit(verify_entry, archive_path, fname, entry))
+
+        for report in pending:
+            yield report.result() if isinstance(report, Future) else report
+
+
+def menu():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='verify game archives')
+    parser.add_argument('directory', help='game directory with archives to verify')
+    parser.add_argument(
+        'patterns',
+        nargs='*',
+        default=ARCHIVE_PATTERNS,
+        help='archive patterns to verify',
+    )
+    parser.add_argument(
+        '--index-only',
+        action='store_true',
+        help='only check index entries against the archive size, without decoding',
+    )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=0,
+        help='number of worker processes (0 uses all cores)',
+    )
+    return parser.parse_args()
+
+
+def main(gamedir, index_only=False, jobs=0, patterns=ARCHIVE_PATTERNS):
+    failed = 0
+    total = 0
+    print(
+        'ARCHIVE',
+        'FILE',
+        'OFFSET',
+        'SIZE',
+        'COMPRESSION',
+        'DECODED',
+        'MS',
+        'STATUS',
+        sep='\t',
+    )
+    reports = verify_game(gamedir, index_only=index_only, jobs=jobs, patterns=patterns)
+    for report in reports:
+        total += 1
+        if report.error:
+            failed += 1
+        print(
+            report.archive,
+            report.name,
+            report.offset,
+            report.size,
+            report.compression,
+            '' if report.decoded_size is None else report.decoded_size,
+            f'{report.seconds * 1000:.2f}',
+            report.error or 'OK',
+            sep='\t',
+        )
+    print(f'{total - failed} of {total} entries OK', file=sys.stderr)
+    return failed == 0
+
+
+if __name__ == '__main__':
+    args = menu()
+
+    if not main(args.directory, args.index_only, args.jobs, args.patterns):
+        sys.exit(1)
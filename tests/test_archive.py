@@ -0,0 +1,302 @@
+import hashlib
+import itertools
+import json
+import os
+from pathlib import Path
+import tempfile
+import unittest
+from unittest import mock
+
+from boozook import archive
+from boozook.codex import stk
+from boozook.codex.stk_compress import pack_content, write_header
+
+
+def reference_game_search(
+    base_dir, patterns, patches=(), archives=archive.ARCHIVE_PATTERNS
+):
+    # The search `GameBase.search` replaced, kept as the reference
+    parsed_files = set()
+
+    base_dir = Path(base_dir)
+
+    if patches is not None:
+        for rp in itertools.chain(patches, ('.',)):
+            patch_dir = base_dir / rp
+            for pattern in patterns:
+                for entry in sorted(patch_dir.glob(pattern)):
+                    if not (entry.is_dir() or entry.name in parsed_files):
+                        parsed_files.add(entry.name)
+                        yield pattern, entry
+
+    for archive_pattern in archives:
+        for archive_path in sorted(base_dir.glob(archive_pattern)):
+            with stk.open(archive_path) as game_archive:
+                for pattern in patterns:
+                    for entry in game_archive.glob(pattern):
+                        if entry.name not in parsed_files:
+                            parsed_files.add(entry.name)
+                            yield pattern, entry
+
+
+def write_archive(path, files, compression=0):
+    # Writes an STK v1 archive storing `files`, compressed or not
+    index = {}
+    body = bytearray()
+    for fname, data in files.items():
+        payload = pack_content(data, 'fast') if compression else data
+        index[fname] = stk.STKFileEntry(len(body), len(payload), compression)
+        body += payload + bytes(len(payload) % 2)
+    path.write_bytes(write_header(index) + body)
+
+
+def found(results):
+    return [(pattern, entry.name, entry.read_bytes()) for pattern, entry in results]
+
+
+class GameSearchTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.base_dir = Path(tmp.name)
+        write_archive(
+            self.base_dir / 'COMMUN.STK',
+            {'INTRO.TOT': b'intro', 'MUSIC.MDY': b'music', 'TEXT.CAT': b'text 1'},
+        )
+        write_archive(
+            self.base_dir / 'DISK2.STK',
+            {'TEXT.CAT': b'text 2', 'ROOM.TOT': b'room', 'FONT.LET': b'font'},
+        )
+        write_archive(self.base_dir / 'SOUND.ITK', {'INTRO.SND': b'sound'})
+        # Loose files are found before archive entries of the same name
+        (self.base_dir / 'ROOM.TOT').write_bytes(b'loose room')
+        (self.base_dir / 'README.TXT').write_bytes(b'readme')
+        (self.base_dir / 'PATCH').mkdir()
+        (self.base_dir / 'PATCH' / 'INTRO.TOT').write_bytes(b'patched intro')
+
+    def test_matches_reference(self):
+        cases = [
+            ['*'],
+            ['*.TOT'],
+            ['*.CAT', '*.TOT'],
+            ['TEXT.CAT', 'ROOM.TOT', 'MISSING.TOT'],
+            ['*.STK'],
+            ['INTRO.*', '*'],
+        ]
+        for patches in [(), ('PATCH',), None]:
+            with archive.open_game(self.base_dir, patches=patches) as game:
+                for patterns in cases:
+                    with self.subTest(patches=patches, patterns=patterns):
+                        expected = found(
+                            reference_game_search(self.base_dir, patterns, patches)
+                        )
+                        self.assertEqual(found(game.search(patterns)), expected)
+
+    def test_precedence(self):
+        with archive.open_game(self.base_dir, patches=('PATCH',)) as game:
+            game.patch_archive(
+                self.base_dir / 'COMMUN.STK',
+                {'INTRO.TOT': b'layer intro', 'TEXT.CAT': b'layer text'},
+            )
+            game.patch('MUSIC.MDY', b'patched music')
+            self.assertEqual(
+                {name: data for _, name, data in found(game.search(['*']))},
+                {
+                    # Patched entries come before everything else
+                    'MUSIC.MDY': b'patched music',
+                    # Then patch directories, as the layer of an archive only
+                    # replaces its own entries
+                    'INTRO.TOT': b'patched intro',
+                    'ROOM.TOT': b'loose room',
+                    'README.TXT': b'readme',
+                    'COMMUN.STK': (self.base_dir / 'COMMUN.STK').read_bytes(),
+                    'DISK2.STK': (self.base_dir / 'DISK2.STK').read_bytes(),
+                    'SOUND.ITK': (self.base_dir / 'SOUND.ITK').read_bytes(),
+                    # The first archive holding a name provides it
+                    'TEXT.CAT': b'layer text',
+                    'FONT.LET': b'font',
+                    'INTRO.SND': b'sound',
+                },
+            )
+            self.assertEqual(found(game.search(['MUSIC.MDY']))[0][2], b'patched music')
+
+    def test_index_entries(self):
+        with archive.open_game(self.base_dir, patches=('PATCH',)) as game:
+            index = game.index
+        self.assertEqual(index['INTRO.TOT'].source, self.base_dir / 'PATCH')
+        self.assertIsNone(index['INTRO.TOT'].archive)
+        self.assertEqual(index['TEXT.CAT'].archive, self.base_dir / 'COMMUN.STK')
+        self.assertEqual(index['FONT.LET'].archive, self.base_dir / 'DISK2.STK')
+        self.assertEqual(index['ROOM.TOT'].source, self.base_dir)
+
+
+class GameIndexTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.base_dir = Path(tmp.name)
+        write_archive(self.base_dir / 'COMMUN.STK', {'INTRO.TOT': b'intro'})
+        write_archive(self.base_dir / 'DISK2.STK', {'ROOM.TOT': b'room'})
+        self.target, _ = archive.write_game_index(self.base_dir)
+
+    def test_loaded_without_scanning(self):
+        with mock.patch('boozook.archive.index_game', side_effect=AssertionError):
+            with archive.open_game(self.base_dir) as game:
+                entry = game.index['ROOM.TOT']
+                self.assertEqual(entry.archive, self.base_dir / 'DISK2.STK')
+
+    def test_written_elsewhere(self):
+        target = self.base_dir / 'elsewhere.json'
+        archive.write_game_index(self.base_dir, target)
+        self.target.unlink()
+        self.assertIsNone(archive.load_game_index(self.base_dir))
+        self.assertIsNotNone(archive.load_game_index(self.base_dir, target))
+
+    def test_stale_mtime(self):
+        path = self.base_dir / 'DISK2.STK'
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertIsNone(archive.load_game_index(self.base_dir))
+
+    def test_stale_size(self):
+        path = self.base_dir / 'DISK2.STK'
+        stat = path.stat()
+        with path.open('ab') as stream:
+            stream.write(b'\0\0')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertIsNone(archive.load_game_index(self.base_dir))
+
+    def test_stale_archive_list(self):
+        write_archive(self.base_dir / 'DISK3.STK', {'END.TOT': b'end'})
+        self.assertIsNone(archive.load_game_index(self.base_dir))
+
+    def test_rescanned_when_stale(self):
+        files = {'ROOM.TOT': b'room', 'NEW.TOT': b'new'}
+        write_archive(self.base_dir / 'DISK2.STK', files)
+        with archive.open_game(self.base_dir) as game:
+            self.assertEqual(game.index['NEW.TOT'].archive, self.base_dir / 'DISK2.STK')
+
+    def test_loose_files_listed_again(self):
+        # Directories are listed again without dropping the archive index
+        (self.base_dir / 'ROOM.TOT').write_bytes(b'loose room')
+        with mock.patch('boozook.archive.index_game', side_effect=AssertionError):
+            with archive.open_game(self.base_dir) as game:
+                self.assertEqual(game.index['ROOM.TOT'].source, self.base_dir)
+                self.assertIsNone(game.index['ROOM.TOT'].archive)
+
+class LinkAliasesTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.base_dir = Path(tmp.name) / 'game'
+        self.base_dir.mkdir()
+        self.target = Path(tmp.name) / 'out'
+        # Both names point at the same payload
+        entry = stk.STKFileEntry(0, 4, 0)
+        (self.base_dir / 'GAME.STK').write_bytes(
+            write_header({'A.TXT': entry, 'B.TXT': entry}) + b'text'
+        )
+
+    def extract(self):
+        with archive.open_game(self.base_dir) as game:
+            archive.extract_archive(game, self.target, link_aliases=True)
+        return self.target / 'GAME.STK'
+
+    def test_linked(self):
+        extracted = self.extract()
+        self.assertTrue(os.path.samefile(extracted / 'A.TXT', extracted / 'B.TXT'))
+
+    def test_copied_without_links(self):
+        error = OSError('links not supported')
+        with mock.patch('boozook.archive.os.link', side_effect=error):
+            extracted = self.extract()
+        self.assertFalse(os.path.samefile(extracted / 'A.TXT', extracted / 'B.TXT'))
+        self.assertEqual((extracted / 'B.TXT').read_bytes(), b'text')
+
+
+class EntryDigestsTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.base_dir = Path(tmp.name) / 'game'
+        self.base_dir.mkdir()
+        self.target = Path(tmp.name) / 'out'
+        self.files = {
+            'A.TXT': b'the door is open ' * 40,
+            'B.TXT': b'take the key ' * 40,
+        }
+        self.changed = b'the door is closed ' * 40
+        self.archive_path = self.base_dir / 'GAME.STK'
+        write_archive(self.archive_path, self.files, compression=1)
+        archive.write_game_index(self.base_dir)
+        self.digests_path = self.base_dir / archive.DIGESTS_NAME
+
+    def rebuild(self):
+        # Returns the entries decoded while rebuilding with B.TXT left as it is
+        decoded = []
+        decode_entry = stk.STKArchive._decode_entry
+
+        def counting(archive, entry):
+            decoded.append(entry)
+            return decode_entry(archive, entry)
+
+        with mock.patch.object(stk.STKArchive, '_decode_entry', counting):
+            with archive.open_game(self.base_dir) as game:
+                game.patch('A.TXT', self.changed)
+                game.patch('B.TXT', self.files['B.TXT'])
+                game.rebuild(self.target)
+
+        with stk.open(self.archive_path) as original:
+            with stk.open(self.target / 'GAME.STK') as rebuilt:
+                self.assertEqual(rebuilt.read_buffer('A.TXT'), self.changed)
+                self.assertEqual(rebuilt.read_buffer('B.TXT'), self.files['B.TXT'])
+                # Copied as stored, not packed again
+                self.assertEqual(
+                    bytes(rebuilt.read_raw(rebuilt.index['B.TXT'])),
+                    bytes(original.read_raw(original.index['B.TXT'])),
+                )
+        return decoded
+
+    def recorded(self):
+        stored = json.loads(self.digests_path.read_text(encoding='utf-8'))
+        return stored['archives']['GAME.STK']
+
+    def test_unchanged_entry_copied_without_decoding(self):
+        self.assertEqual(len(self.rebuild()), 2)
+        self.assertEqual(
+            self.recorded()['entries'],
+            {
+                fname: hashlib.sha1(data).hexdigest()
+                for fname, data in self.files.items()
+            },
+        )
+        self.assertEqual(self.rebuild(), [])
+
+    def test_stale_digests_decoded_again(self):
+        self.rebuild()
+        stat = self.archive_path.stat()
+        os.utime(self.archive_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        # The game index is stale too, it is written again for the digests
+        archive.write_game_index(self.base_dir)
+        self.assertEqual(len(self.rebuild()), 2)
+        self.assertEqual(self.rebuild(), [])
+
+    def test_mismatched_digests_decoded_again(self):
+        self.rebuild()
+        stored = json.loads(self.digests_path.read_text(encoding='utf-8'))
+        stored['archives']['GAME.STK']['size'] += 1
+        self.digests_path.write_text(json.dumps(stored), encoding='utf-8')
+        self.assertEqual(len(self.rebuild()), 2)
+        self.assertEqual(self.recorded()['size'], self.archive_path.stat().st_size)
+
+    def test_digests_of_other_versions_ignored(self):
+        self.rebuild()
+        stored = json.loads(self.digests_path.read_text(encoding='utf-8'))
+        stored['version'] = archive.DIGESTS_VERSION + 1
+        self.digests_path.write_text(json.dumps(stored), encoding='utf-8')
+        self.assertEqual(archive.load_digests(self.base_dir, self.digests_path), {})
+        self.assertEqual(len(self.rebuild()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+from boozook.cache import ArchiveStamp, EntryCache
+
+
+class EntryCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = Path(tmp.name)
+
+    def age(self, cache, keys):
+        # Gives entries distinct access times in the past, oldest first
+        for idx, key in enumerate(keys):
+            os.utime(cache.directory / key, ns=(idx * 10**9, idx * 10**9))
+
+    def stored(self, cache):
+        return sorted(entry.name for entry in cache.directory.iterdir())
+
+    def test_round_trip(self):
+        cache = EntryCache(self.directory)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', b'data')
+        self.assertEqual(cache.get('a'), b'data')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_evicted(self):
+        cache = EntryCache(self.directory, max_size=300)
+        for key in 'abc':
+            cache.put(key, bytes(100))
+        self.age(cache, 'abc')
+        # Reading refreshes an entry, so b is now the least recently used
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('d', bytes(100))
+        self.assertEqual(self.stored(cache), ['a', 'c', 'd'])
+
+        self.age(cache, 'cad')
+        cache.put('e', bytes(150))
+        self.assertEqual(self.stored(cache), ['d', 'e'])
+
+    def test_larger_than_cache_not_stored(self):
+        cache = EntryCache(self.directory, max_size=100)
+        cache.put('a', bytes(101))
+        self.assertEqual(self.stored(cache), [])
+
+    def test_overwritten_entry_counted_once(self):
+        cache = EntryCache(self.directory, max_size=300)
+        cache.put('a', bytes(100))
+        cache.put('b', bytes(100))
+        for size in (100, 150, 50):
+            cache.put('a', bytes(size))
+        self.assertEqual(cache._usage, 150)
+        cache.put('c', bytes(150))
+        self.assertEqual(self.stored(cache), ['a', 'b', 'c'])
+
+    def test_usage_of_existing_entries(self):
+        EntryCache(self.directory).put('a', bytes(200))
+        cache = EntryCache(self.directory, max_size=300)
+        self.age(cache, 'a')
+        cache.put('b', bytes(200))
+        self.assertEqual(self.stored(cache), ['b'])
+
+    def test_keys(self):
+        stamp = ArchiveStamp('/game/GAME.STK', 1000, 1)
+        key = EntryCache.key(stamp, 10, 20, 1)
+        self.assertEqual(key, EntryCache.key(stamp, 10, 20, True))
+        self.assertNotEqual(key, EntryCache.key(stamp._replace(mtime=2), 10, 20, 1))
+        self.assertNotEqual(key, EntryCache.key(stamp, 10, 20, 2))
+
+        content = EntryCache.content_key(b'data', 'lzss:fast')
+        self.assertEqual(content, EntryCache.content_key(b'data', 'lzss:fast'))
+        self.assertNotEqual(content, EntryCache.content_key(b'data', 'lzss:optimal'))
+        self.assertNotEqual(content, EntryCache.content_key(b'other', 'lzss:fast'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import io
+import random
+import struct
+import unittest
+
+from boozook.codex import stk
+
+
+def reference_unpack_chunk(stream, size):
+    # The byte by byte decoder `decode_lzss` replaced, kept as the reference
+    buffer_index = 4078
+    buffer = bytearray(b'\x20' * buffer_index + b'\0' * 36)
+    result = b''
+
+    command = 0
+    while True:
+        command >>= 1
+        if command & 0x0100 == 0:
+            command = ord(stream.read(1)) | 0xFF00
+
+        if command & 1 != 0:
+            temp = stream.read(1)
+            result += temp
+            buffer[buffer_index] = ord(temp)
+            buffer_index += 1
+            buffer_index %= 4096
+            size -= 1
+            if not size:
+                break
+        else:
+            hi, low = stream.read(2)
+
+            offset = hi | ((low & 0xF0) << 4)
+            length = (low & 0x0F) + 3
+
+            for i in range(length):
+                result += bytes([buffer[(offset + i) % 4096]])
+                size -= 1
+                if not size:
+                    return bytes(result)
+
+                buffer[buffer_index] = buffer[(offset + i) % 4096]
+                buffer_index += 1
+                buffer_index %= 4096
+
+    return bytes(result)
+
+
+def random_bitstream(rnd, length):
+    # Mostly back-references, so matches overlap and wrap around the ring
+    data = bytearray()
+    while len(data) < length:
+        flags = rnd.choice((0x00, 0xFF, rnd.randrange(256)))
+        data.append(flags)
+        for bit in range(8):
+            if flags >> bit & 1:
+                data.append(rnd.randrange(256))
+            else:
+                data += rnd.randbytes(2)
+    return bytes(data[:length])
+
+
+class DecodeLZSSTest(unittest.TestCase):
+    def check(self, data, size):
+        with io.BytesIO(data) as stream:
+            try:
+                expected = reference_unpack_chunk(stream, size)
+            except (TypeError, ValueError):
+                expected = None
+            expected_end = stream.tell()
+
+        if expected is None:
+            # The reference fails on truncated input in whichever way it ran out
+            with self.assertRaises(EOFError):
+                stk.decode_lzss(data, size)
+            return
+        result, end = stk.decode_lzss(data, size)
+        self.assertEqual(result, expected)
+        self.assertEqual(end, expected_end)
+
+    def test_random_bitstreams(self):
+        rnd = random.Random(0)
+        for _ in range(500):
+            data = random_bitstream(rnd, rnd.randrange(1, 2000))
+            self.check(data, rnd.randrange(1, 6000))
+
+    def test_truncated(self):
+        rnd = random.Random(1)
+        for _ in range(200):
+            data = random_bitstream(rnd, 1000)
+            size = len(reference_unpack_chunk(io.BytesIO(data), 800))
+            self.check(data[: rnd.randrange(len(data))], size)
+
+    def test_unpack_chunk_stream_position(self):
+        rnd = random.Random(2)
+        data = random_bitstream(rnd, 3000)
+        with io.BytesIO(b'head' + data) as stream:
+            stream.seek(4)
+            result = stk.unpack_chunk(stream, 1500)
+            end = stream.tell()
+        with io.BytesIO(b'head' + data) as stream:
+            stream.seek(4)
+            self.assertEqual(result, reference_unpack_chunk(stream, 1500))
+            self.assertEqual(end, stream.tell())
+
+
+def make_payload(rnd, sizes):
+    # A chunked payload of valid bitstreams decoding to `sizes` bytes each, as
+    # laid out for compression 2, and the content it decodes to
+    payload = bytearray()
+    content = b''
+    for idx, size in enumerate(sizes):
+        data = random_bitstream(rnd, size * 2)
+        chunk, end = stk.decode_lzss(data, size)
+        last = idx + 1 == len(sizes)
+        payload += struct.pack('<3H', 0xFFFF if last else end + 4, size, 0)
+        payload += data[:end]
+        content += chunk
+    return bytes(payload), content
+
+
+class LZSSReaderTest(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(3)
+        self.payload, self.content = make_payload(rnd, [5000, 3000, 0x7000])
+
+    def readers(self):
+        chunks = stk.find_chunks(self.payload)
+        yield stk.LZSSReader(self.payload, chunks)
+        yield stk.LZSSReader(io.BytesIO(self.payload), chunks, block_size=1000)
+
+    def test_read_sequential(self):
+        for reader in self.readers():
+            with self.subTest(reader=reader), reader:
+                parts = iter(lambda: reader.read(777), b'')
+                self.assertEqual(b''.join(parts), self.content)
+                self.assertEqual(reader.tell(), len(self.content))
+
+    def test_seek_and_read(self):
+        rnd = random.Random(4)
+        for reader in self.readers():
+            with self.subTest(reader=reader), reader:
+                for _ in range(50):
+                    pos = rnd.randrange(len(self.content))
+                    size = rnd.randrange(1, 10000)
+                    self.assertEqual(reader.seek(pos), pos)
+                    # Raw reads stop short at the end of a chunk
+                    data = reader.read(size)
+                    self.assertTrue(data)
+                    self.assertEqual(data, self.content[pos : pos + len(data)])
+                    self.assertEqual(reader.tell(), pos + len(data))
+
+    def test_readall(self):
+        for reader in self.readers():
+            with self.subTest(reader=reader), reader:
+                self.assertEqual(reader.readall(), self.content)
+                reader.seek(-100, io.SEEK_END)
+                self.assertEqual(reader.readall(), self.content[-100:])
+
+    def test_read_at_and_past_eof(self):
+        for reader in self.readers():
+            with self.subTest(reader=reader), reader:
+                reader.seek(0, io.SEEK_END)
+                self.assertEqual(reader.read(10), b'')
+                self.assertEqual(reader.read(), b'')
+                reader.seek(len(self.content) + 5)
+                self.assertEqual(reader.read(10), b'')
+                self.assertEqual(reader.read(), b'')
+                self.assertEqual(reader.readall(), b'')
+                self.assertEqual(reader.tell(), len(self.content) + 5)
+
+    def test_buffered_past_eof(self):
+        stream = stk.unpack_buffer(self.payload, 2)
+        stream.seek(len(self.content) + 5)
+        self.assertEqual(stream.read(), b'')
+        stream.seek(10)
+        self.assertEqual(stream.read(9000), self.content[10:9010])
+        self.assertEqual(stream.read(), self.content[9010:])
+
+    def test_single_chunk(self):
+        rnd = random.Random(5)
+        data = random_bitstream(rnd, 8000)
+        content, end = stk.decode_lzss(data, 6000)
+        payload = struct.pack('<I', len(content)) + data[:end]
+        stream = stk.unpack_buffer(payload, 1)
+        self.assertEqual(stream.read(), content)
+        stream.seek(3000)
+        self.assertEqual(stream.read(100), content[3000:3100])
+
+
+if __name__ == '__main__':
+    unittest.main()
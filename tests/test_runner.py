@@ -0,0 +1,32 @@
+import unittest
+
+from boozook import runner
+
+
+class IndexCommandTest(unittest.TestCase):
+    def test_index_command(self):
+        args = runner.menu(['index', 'GAME', '-o', 'game.json'])
+        self.assertEqual(args.command, 'index')
+        self.assertEqual((args.directory, args.output), ('GAME', 'game.json'))
+
+    def test_index_command_after_common_options(self):
+        args = runner.menu(['--experimental', 'index', 'GAME'])
+        self.assertEqual(args.command, 'index')
+        self.assertTrue(args.experimental)
+        self.assertEqual((args.directory, args.output), ('GAME', None))
+
+    def test_game_directory(self):
+        args = runner.menu(['./index', '-t', '--index', 'game.json'])
+        self.assertIsInstance(args, runner.ProgramArgs)
+        self.assertEqual(str(args.gamedir), 'index')
+        self.assertEqual(list(args.resources), ['texts'])
+        self.assertEqual(str(args.options['index_path']), 'game.json')
+
+    def test_option_value_named_index(self):
+        args = runner.menu(['-a', '-p', 'index'])
+        self.assertEqual(str(args.gamedir), '.')
+        self.assertEqual(args.resources, {'archive': {'patterns': ['index']}})
+
+
+if __name__ == '__main__':
+    unittest.main()
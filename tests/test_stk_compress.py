@@ -0,0 +1,305 @@
+from contextlib import redirect_stderr
+import io
+from pathlib import Path
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from boozook.cache import EntryCache
+from boozook.codex import stk
+from boozook.codex.base import write_uint32_le
+from boozook.codex.stk_compress import (
+    COMPRESSION_LEVELS,
+    append_archive,
+    pack_cached,
+    pack_content,
+    recompress_archive,
+    submit_payload,
+    write_header,
+    write_payload,
+    write_stk21_trailer,
+)
+
+
+def sample_contents(rnd):
+    # Runs longer than a match, repeats further apart than the window and
+    # spaces matching the initial dictionary
+    words = [rnd.randbytes(rnd.randrange(1, 12)) for _ in range(40)]
+    text = b' '.join(rnd.choice(words) for _ in range(2000))
+    return [
+        b'',
+        b'a',
+        b'ab',
+        b'abc' * 3,
+        b' ' * 5000,
+        b'x' + b'ab' * 3000,
+        text,
+        rnd.randbytes(3000),
+        rnd.randbytes(5000) * 2,
+    ]
+
+
+def write_archive(path, files):
+    # Writes an STK v1 archive of `files`, mapping names to their content and
+    # compression
+    index = {}
+    body = bytearray()
+    for fname, (data, compression) in files.items():
+        payload = submit_payload(None, data, compression, 'fast', None)()
+        index[fname] = stk.STKFileEntry(len(body), len(payload), compression)
+        body += payload + bytes(len(payload) % 2)
+    path.write_bytes(write_header(index) + body)
+
+
+def write_stk21_archive(path, files):
+    # Same as `write_archive`, for an STK2.1 archive
+    date = b'01012000120000'
+    creator = b'test'.ljust(8, b'\0')
+    index = {}
+    with path.open('wb') as output:
+        output.write(bytes(32))
+        for fname, (data, compression) in files.items():
+            payload = submit_payload(None, data, compression, 'fast', None)()
+            index[fname] = stk.STK21FileEntry(
+                output.tell() - 32,
+                len(payload),
+                compression,
+                len(data),
+                date,
+                date,
+                creator,
+                bytes(5),
+            )
+            output.write(payload)
+        trailer = output.tell()
+        write_stk21_trailer(output, index, 32)
+        output.seek(0)
+        output.write(b'STK2.1' + date + creator + write_uint32_le(trailer))
+
+
+class PackContentTest(unittest.TestCase):
+    def test_round_trip(self):
+        rnd = random.Random(0)
+        for level in COMPRESSION_LEVELS:
+            for data in sample_contents(rnd):
+                with self.subTest(level=level, size=len(data)):
+                    packed = pack_content(data, level)
+                    self.assertEqual(int.from_bytes(packed[:4], 'little'), len(data))
+                    result, end = stk.decode_lzss(packed, len(data), 4)
+                    self.assertEqual(result, data)
+                    self.assertEqual(end, len(packed))
+
+    def test_budget_fallback_is_not_cached(self):
+        data = sample_contents(random.Random(2))[6]
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = EntryCache(tmp)
+            with redirect_stderr(io.StringIO()) as err:
+                packed = pack_cached(data, 'optimal', 0, cache)
+            self.assertIn('packed fast', err.getvalue())
+            self.assertEqual(packed, pack_content(data, 'fast'))
+            self.assertEqual(list(Path(tmp).iterdir()), [])
+
+            packed = pack_cached(data, 'optimal', None, cache)
+            self.assertEqual(pack_cached(data, 'optimal', None, cache), packed)
+            # Stored payloads are full outputs of their level, whatever the budget
+            self.assertEqual(pack_cached(data, 'optimal', 60, cache), packed)
+            self.assertEqual(cache.hits, 2)
+
+
+class ChunkReuseTest(unittest.TestCase):
+    def setUp(self):
+        text = sample_contents(random.Random(3))[6]
+        self.data = (text * 6)[:0x7000 * 3 + 0x1000]
+        # Repacked chunks differ from these, as they are packed at another level
+        self.stored = submit_payload(None, self.data, 2, 'fast', None)()
+
+    def repack(self, data, stored=None):
+        original = (stored or self.stored), self.data
+        packed = submit_payload(None, data, 2, 'balanced', None, original=original)()
+        self.assertEqual(stk.unpack_chunks(packed), data)
+        return [bytes(span) for span, _ in stk.chunk_spans(packed)]
+
+    def test_head_reused(self):
+        previous = [bytes(span) for span, _ in stk.chunk_spans(self.stored)]
+        spans = self.repack(self.data[:0x7000 * 2] + b'changed' * 100)
+        self.assertEqual(spans[:2], previous[:2])
+        self.assertNotIn(spans[-1], previous)
+
+    def test_tail_reused(self):
+        previous = [bytes(span) for span, _ in stk.chunk_spans(self.stored)]
+        spans = self.repack(b'changed' * 100 + self.data[0x7000:])
+        self.assertNotIn(spans[0], previous)
+        self.assertEqual(spans[-3:], previous[-3:])
+
+    def test_padded_last_chunk_reused_before_new_chunks(self):
+        # The stored last chunk runs to the end of the entry, padding included
+        spans = self.repack(self.data + bytes(range(40)), self.stored + bytes(4))
+        previous = [bytes(span) for span, _ in stk.chunk_spans(self.stored)]
+        self.assertEqual(spans[:4], previous)
+
+
+class RecompressArchiveTest(unittest.TestCase):
+    def test_parallel_matches_serial(self):
+        rnd = random.Random(1)
+        texts = sample_contents(rnd)
+        files = {
+            'A.TXT': (texts[6], 1),
+            'B.BIN': (rnd.randbytes(301), 0),
+            'C.TXT': (texts[5], 1),
+            'D.0OT': (texts[6] * 20, 2),
+            'E.TXT': (texts[4], 1),
+        }
+        patches = {
+            'A.TXT': texts[6][::-1],
+            'C.TXT': texts[5] + b'tail',
+            'D.TOT': texts[6][:30000] + texts[6] * 2,
+            'F.TXT': b'new file',
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            write_archive(tmp / 'GAME.STK', files)
+            for jobs in (1, 2):
+                with stk.open(tmp / 'GAME.STK') as archive:
+                    recompress_archive(
+                        archive, dict(patches), tmp / f'{jobs}.STK', jobs=jobs
+                    )
+            self.assertEqual(
+                (tmp / '1.STK').read_bytes(), (tmp / '2.STK').read_bytes()
+            )
+            with stk.open(tmp / '2.STK') as archive:
+                self.assertEqual(archive.read_buffer('D.TOT'), patches['D.TOT'])
+                self.assertEqual(archive.read_buffer('F.TXT'), patches['F.TXT'])
+
+
+
+class FailingPatches(dict):
+    # Patches that cannot be read past the first ones
+    def __getitem__(self, fname):
+        if fname == 'C.TXT':
+            raise OSError(f'cannot read {fname}')
+        return super().__getitem__(fname)
+
+
+class AppendArchiveTest(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(4)
+        texts = sample_contents(rnd)
+        self.files = {
+            'A.TXT': (texts[6], 1),
+            'B.BIN': (rnd.randbytes(301), 0),
+            'C.TXT': (texts[5], 1),
+            'D.TOT': (texts[6] * 20, 2),
+            'E.TXT': (texts[4], 1),
+        }
+        self.patches = {
+            'B.BIN': rnd.randbytes(100),
+            'C.TXT': texts[5] + b'tail',
+            'D.TOT': texts[6][:30000] + texts[6] * 2,
+            # Left as it is, so it is not appended
+            'E.TXT': texts[4],
+        }
+        self.added = {'F.TXT': b'new file'}
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+    def write(self, version, name='GAME.STK'):
+        path = self.tmp / name
+        if version == 2.1:
+            write_stk21_archive(path, self.files)
+        else:
+            # STK v1 marks chunked entries by name
+            write_archive(
+                path,
+                {
+                    fname.replace('.TOT', '.0OT'): content
+                    for fname, content in self.files.items()
+                },
+            )
+        return path
+
+    def check_appended(self, source, target, patches):
+        end = source.stat().st_size
+        with stk.open(source) as archive:
+            entries = dict(archive.index)
+            raws = {
+                fname: bytes(archive.read_raw(entry))
+                for fname, entry in entries.items()
+            }
+            append_archive(archive, patches, target)
+
+        changed = {'B.BIN', 'C.TXT', 'D.TOT'}
+        with stk.open(target) as archive:
+            self.assertEqual(set(archive.index), set(entries) | set(patches))
+            for fname, data in patches.items():
+                self.assertEqual(archive.read_buffer(fname), data)
+            for fname, entry in entries.items():
+                if fname in changed:
+                    self.assertGreaterEqual(archive.index[fname].offset, end)
+                    continue
+                self.assertEqual(archive.index[fname], entry)
+                self.assertEqual(bytes(archive.read_raw(entry)), raws[fname])
+                self.assertEqual(archive.read_buffer(fname), self.files[fname][0])
+
+    def test_append_stk1(self):
+        source = self.write(1)
+        original = source.read_bytes()
+        self.check_appended(source, self.tmp / 'OUT.STK', self.patches)
+        self.assertEqual(source.read_bytes(), original)
+
+        # New files need a larger header, which is not rewritten
+        with stk.open(source) as archive, self.assertRaises(ValueError):
+            append_archive(archive, self.added, self.tmp / 'NEW.STK')
+
+    def test_append_stk21(self):
+        source = self.write(2.1)
+        original = source.read_bytes()
+        patches = dict(self.patches, **self.added)
+        self.check_appended(source, self.tmp / 'OUT.STK', patches)
+        self.assertEqual(source.read_bytes(), original)
+
+    def test_append_in_place(self):
+        for version in (1, 2.1):
+            with self.subTest(version=version):
+                source = self.write(version)
+                patches = dict(self.patches)
+                if version == 2.1:
+                    patches.update(self.added)
+                self.check_appended(source, source, patches)
+
+    def test_interrupted_append_in_place(self):
+        calls = []
+
+        def failing_write(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                raise OSError('disk full')
+            return write_payload(*args, **kwargs)
+
+        for version in (1, 2.1):
+            with self.subTest(version=version):
+                source = self.write(version)
+                original = source.read_bytes()
+                calls.clear()
+                patch = mock.patch(
+                    'boozook.codex.stk_compress.write_payload', failing_write
+                )
+                with patch, stk.open(source) as archive, self.assertRaises(OSError):
+                    append_archive(archive, self.patches, source)
+                self.assertEqual(source.read_bytes(), original)
+
+    def test_interrupted_rewrite_in_place(self):
+        for version in (1, 2.1):
+            with self.subTest(version=version):
+                source = self.write(version)
+                original = source.read_bytes()
+                patches = FailingPatches(self.patches)
+                with stk.open(source) as archive, self.assertRaises(OSError):
+                    recompress_archive(archive, patches, source)
+                self.assertEqual(source.read_bytes(), original)
+                self.assertEqual(list(self.tmp.iterdir()), [source])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+from datetime import datetime, timedelta
+import io
+import random
+import struct
+import unittest
+
+from pakal.examples.common import read_uint16_le, read_uint32_le, safe_readcstr
+
+from boozook.codex import stk
+
+
+def reference_extract_stk21(stream):
+    # The per-entry parsers `STKIndex` replaced, kept as the reference
+    _date = stream.read(14)
+    _creator = stream.read(8)
+    file_names_offset = read_uint32_le(stream)
+    stream.seek(file_names_offset)
+    file_count = read_uint32_le(stream)
+    misc_offset = read_uint32_le(stream)
+    for cpt in range(file_count):
+        stream.seek(misc_offset + cpt * 61)
+        filename_offset = read_uint32_le(stream)
+        modified = datetime.strptime(stream.read(14).decode(), '%d%m%Y%H%M%S')
+        created = datetime.strptime(stream.read(14).decode(), '%d%m%Y%H%M%S')
+        creator = stream.read(8).split(b'\0')[0].decode()
+        size = read_uint32_le(stream)
+        uncompressed_size = read_uint32_le(stream)
+        unk = stream.read(5)
+        offset = read_uint32_le(stream)
+        compression = read_uint32_le(stream)
+        stream.seek(filename_offset)
+        file_name = safe_readcstr(stream).decode()
+        yield file_name, (
+            offset,
+            size,
+            compression,
+            uncompressed_size,
+            modified,
+            created,
+            creator,
+            unk,
+        )
+
+
+def reference_extract(stream):
+    file_count = read_uint16_le(stream)
+    for _i in range(file_count):
+        raw_fname = stream.read(13)
+        file_name = raw_fname.split(b'\0')[0].decode()
+        size = read_uint32_le(stream)
+        offset = read_uint32_le(stream)
+        compression = stream.read(1) != b'\00'
+        if file_name.upper().endswith('.0OT'):
+            compression = 2
+            file_name = file_name.replace('.0OT', '.TOT')
+
+        # Replacing cyrillic characters
+        reps = ('\x85', 'E'), ('\x8A', 'K'), ('\x8E', 'O'), ('\x91', 'C'), ('\x92', 'T')
+        file_name = stk.replace_many(file_name, *reps)
+
+        yield file_name, (offset, size, int(compression))
+
+
+def reference_aliases(index):
+    first = {}
+    aliases = {}
+    for fname, entry in index.items():
+        canonical = first.setdefault(entry[:3], fname)
+        if canonical != fname:
+            aliases[fname] = canonical
+    return aliases
+
+
+def random_names(rnd, count):
+    # Names with extensions marking chunked entries, cyrillic characters and
+    # a few repeated names
+    names = []
+    for _ in range(count):
+        length = rnd.randrange(1, 9)
+        stem = ''.join(rnd.choice('ABCDEFGHIJ0123456789') for _ in range(length))
+        ext = rnd.choice(['TOT', '0OT', 'STK', 'CAT', 'SND', 'tot', '0ot'])
+        names.append(f'{stem}.{ext}'.encode())
+    names += [b'\xc2\x85\xc2\x8aRT.TOT', b'\xc2\x92\xc2\x91.0OT']
+    names += rnd.sample(names, min(count, 3))
+    return names
+
+
+def random_records(rnd, count):
+    # Offsets and sizes, some shared by several records
+    records = []
+    for _ in range(count):
+        if records and rnd.random() < 0.2:
+            records.append(rnd.choice(records))
+        else:
+            records.append((rnd.randrange(1 << 24), rnd.randrange(1 << 20)))
+    return records
+
+
+def write_stk1_index(rnd, count):
+    names = random_names(rnd, count)
+    data = bytearray(struct.pack('<H', len(names)))
+    for name, (offset, size) in zip(names, random_records(rnd, len(names))):
+        compression = rnd.choice((0, 0, 1, 2, 255))
+        data += name.ljust(13, b'\0') + struct.pack('<IIB', size, offset, compression)
+    return bytes(data)
+
+
+def write_stk21_index(rnd, count):
+    names = random_names(rnd, count)
+    header = b'STK2.1' + bytes(22)
+    trailer = len(header) + 4 + rnd.randrange(100)
+    # Names are stored in another order than the records pointing to them
+    order = rnd.sample(range(len(names)), len(names))
+    name_offsets = [0] * len(names)
+    names_data = bytearray()
+    for idx in order:
+        name_offsets[idx] = trailer + 8 + len(names_data)
+        names_data += names[idx] + b'\0'
+    records = random_records(rnd, len(names))
+    misc = bytearray()
+    for name_offset, (offset, size) in zip(name_offsets, records):
+        misc += struct.pack('<I', name_offset)
+        for _ in range(2):
+            date = datetime(1995, 1, 1) + timedelta(seconds=rnd.randrange(1 << 28))
+            misc += stk.format_date(date)
+        misc += rnd.choice([b'Boozook', b'CV', b'']).ljust(8, b'\0')
+        misc += struct.pack('<II', size, rnd.randrange(1 << 20))
+        misc += rnd.randbytes(5) + struct.pack('<II', offset, rnd.choice((0, 1, 2)))
+    data = bytearray(header + struct.pack('<I', trailer))
+    data += bytes(trailer - len(data))
+    data += struct.pack('<II', len(names), trailer + 8 + len(names_data))
+    return bytes(data + names_data + misc)
+
+
+class STKIndexTest(unittest.TestCase):
+    def test_stk1(self):
+        rnd = random.Random(0)
+        for count in (0, 1, 20, 500):
+            with self.subTest(count=count):
+                data = write_stk1_index(rnd, count)
+                expected = dict(reference_extract(io.BytesIO(data)))
+                index = stk.extract(io.BytesIO(data))
+                self.assertEqual(list(index), list(expected))
+                self.assertEqual(len(index), len(expected))
+                for fname, entry in expected.items():
+                    self.assertIsInstance(index[fname], stk.STKFileEntry)
+                    self.assertEqual(tuple(index[fname]), entry)
+                self.assertEqual(index.aliases, reference_aliases(expected))
+
+    def test_stk21(self):
+        rnd = random.Random(1)
+        for count in (0, 1, 20, 500):
+            with self.subTest(count=count):
+                data = write_stk21_index(rnd, count)
+                stream = io.BytesIO(data)
+                stream.seek(6)
+                expected = dict(reference_extract_stk21(stream))
+                stream.seek(6)
+                index = stk.extract_stk21(stream)
+                self.assertEqual(list(index), list(expected))
+                self.assertEqual(len(index), len(expected))
+                for fname, entry in expected.items():
+                    found = index[fname]
+                    self.assertIsInstance(found, stk.STK21FileEntry)
+                    self.assertEqual(
+                        (
+                            *found[:4],
+                            found.modified,
+                            found.created,
+                            found.creator,
+                            found.unk,
+                        ),
+                        entry,
+                    )
+                self.assertEqual(index.aliases, reference_aliases(expected))
+
+    def test_truncated(self):
+        rnd = random.Random(2)
+        data = write_stk1_index(rnd, 20)
+        with self.assertRaises(EOFError):
+            stk.extract(io.BytesIO(data[:-1]))
+        data = write_stk21_index(rnd, 20)
+        stream = io.BytesIO(data[:-1])
+        stream.seek(6)
+        with self.assertRaises(EOFError):
+            stk.extract_stk21(stream)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+from contextlib import redirect_stderr, redirect_stdout
+import io
+from pathlib import Path
+import struct
+import tempfile
+import unittest
+
+from boozook import verify
+from boozook.codex import stk
+from boozook.codex.stk_compress import pack_content, write_header
+
+
+def write_archive(path, files):
+    # Writes an STK v1 archive of `files`, mapping names to their content and
+    # whether to compress it
+    index = {}
+    body = bytearray()
+    for fname, (data, compression) in files.items():
+        payload = pack_content(data, 'fast') if compression else data
+        index[fname] = stk.STKFileEntry(len(body), len(payload), compression)
+        body += payload + bytes(len(payload) % 2)
+    path.write_bytes(write_header(index) + body)
+
+
+class VerifyTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.base_dir = Path(tmp.name)
+        self.archive_path = self.base_dir / 'GAME.STK'
+        write_archive(
+            self.archive_path,
+            {
+                'A.TXT': (b'the door is open ' * 40, 1),
+                'B.BIN': (bytes(range(200)), 0),
+                'C.TXT': (b'take the key ' * 40, 1),
+            },
+        )
+
+    def run_main(self, **kwargs):
+        with redirect_stdout(io.StringIO()) as out, redirect_stderr(io.StringIO()):
+            result = verify.main(self.base_dir, jobs=1, **kwargs)
+        rows = [line.split('\t') for line in out.getvalue().splitlines()[1:]]
+        return result, {row[1]: row for row in rows}
+
+    def test_good_archive(self):
+        result, rows = self.run_main()
+        self.assertTrue(result)
+        self.assertEqual(list(rows), ['A.TXT', 'B.BIN', 'C.TXT'])
+        for row in rows.values():
+            self.assertEqual(row[-1], 'OK')
+        self.assertEqual(rows['A.TXT'][5], str(len(b'the door is open ' * 40)))
+
+    def test_corrupted_entry(self):
+        with stk.open(self.archive_path) as archive:
+            entry = archive.index['C.TXT']
+        # Declares more content than the payload decodes to
+        with self.archive_path.open('r+b') as stream:
+            stream.seek(entry.offset)
+            stream.write(struct.pack('<I', 100000))
+
+        result, rows = self.run_main()
+        self.assertFalse(result)
+        self.assertEqual(rows['A.TXT'][-1], 'OK')
+        self.assertEqual(rows['B.BIN'][-1], 'OK')
+        self.assertTrue(rows['C.TXT'][-1].startswith('EOFError'), rows['C.TXT'])
+
+    def test_entry_past_end_of_file(self):
+        data = self.archive_path.read_bytes()
+        self.archive_path.write_bytes(data[:-10])
+
+        result, rows = self.run_main(index_only=True)
+        self.assertFalse(result)
+        self.assertEqual(rows['A.TXT'][-1], 'OK')
+        self.assertIn('past end of file', rows['C.TXT'][-1])
+
+
+if __name__ == '__main__':
+    unittest.main()